@@ -68,7 +68,7 @@ class VanillaCallOption(Asset):
 
     def volatility(self, scenario):
         # S: spot price
-        S = self.asset(scenario)
+        S = self.asset.price(scenario)
         # K: strike price
         K = self.strike
 
@@ -87,7 +87,6 @@ class VanillaCallOption(Asset):
             1
             / np.sqrt(2 * np.pi)
             * S
-            * np.exp(-q * T)
             * np.exp(-(d1 ** 2) * 0.5)
             * np.sqrt(T)
         )
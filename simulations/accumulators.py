@@ -0,0 +1,196 @@
+import numpy as np
+
+
+class QuantileSketch:  # Merging t-digest - mergeable, accurate in the tails
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.minimum = np.nan
+        self.maximum = np.nan
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values):
+            self.add_centroids(values, np.ones(len(values)))
+        return self
+
+    def merge(self, other):
+        if len(other.weights):
+            self.add_centroids(other.means, other.weights)
+        return self
+
+    def add_centroids(self, means, weights):
+        self.minimum = np.fmin(self.minimum, means.min())
+        self.maximum = np.fmax(self.maximum, means.max())
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+
+        # Centroids are grouped by the integer part of the k1 scale function
+        # k(q) = compression / (2 pi) * asin(2q - 1), which keeps the
+        # centroids small (and quantiles accurate) near q = 0 and q = 1.
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        groups = np.floor(k).astype(int)
+        groups -= groups[0]
+        self.weights = np.bincount(groups, weights=weights)
+        sums = np.bincount(groups, weights=weights * means)
+        nonempty = self.weights > 0
+        self.weights = self.weights[nonempty]
+        self.means = sums[nonempty] / self.weights
+
+    def quantile(self, q):
+        if not len(self.weights):
+            return np.nan
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return np.interp(
+            q * self.count,
+            np.concatenate([[0.0], centers, [self.count]]),
+            np.concatenate([[self.minimum], self.means, [self.maximum]]),
+        )
+
+    def lower_tail_mean(self, q):
+        # Mean of the values below the q-quantile; the centroid crossing
+        # the quantile contributes only its part below it.
+        tail = q * self.count
+        if not tail:
+            return np.nan
+        before = np.cumsum(self.weights) - self.weights
+        below = np.clip(tail - before, 0.0, self.weights)
+        return np.sum(below * self.means) / tail
+
+
+class PriceStatistics:  # Accumulator - constant memory, mergeable
+    def __init__(self, compression=None, estimator=None):
+        self.count = 0
+        self.mean = np.nan
+        self.m2 = 0.0  # sum of squared deviations from the mean
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.sketch = None if compression is None else QuantileSketch(compression)
+        # standard error of the mean for dependent samples (antithetic pairs,
+        # QMC replicates) - the prices are then updated in scenario order
+        self.estimator = estimator
+
+    def update(self, prices):
+        prices = np.asarray(prices, dtype=float).ravel()
+        if len(prices):
+            batch = PriceStatistics()
+            batch.count = len(prices)
+            batch.mean = prices.mean()
+            batch.m2 = np.sum((prices - batch.mean) ** 2)
+            batch.minimum = prices.min()
+            batch.maximum = prices.max()
+            self.merge(batch)
+            if self.sketch is not None:
+                self.sketch.update(prices)
+            if self.estimator is not None:
+                self.estimator.update(prices)
+        return self
+
+    def merge(self, other):
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        if self.estimator is not None and other.estimator is not None:
+            self.estimator.merge(other.estimator)
+        # Welford update generalized to batches (Chan et al.)
+        if not other.count:
+            return self
+        if not self.count:
+            self.count = other.count
+            self.mean = other.mean
+            self.m2 = other.m2
+            self.minimum = other.minimum
+            self.maximum = other.maximum
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def standard_error(self):  # of the mean
+        if self.estimator is not None:
+            return self.estimator.standard_error
+        return self.std / np.sqrt(self.count) if self.count else np.nan
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    def value_at_risk(self, confidence_level=0.99):
+        # loss relative to the mean price
+        return self.mean - self.quantile(1.0 - confidence_level)
+
+    def expected_shortfall(self, confidence_level=0.99):
+        return self.mean - self.sketch.lower_tail_mean(1.0 - confidence_level)
+
+
+class AntitheticStandardError:  # a pair x, -x is one independent sample
+    def __init__(self):
+        self.pairs = PriceStatistics()  # of the pair means
+        self.unpaired = np.zeros(0)  # the first of a pair split by a batch
+
+    def update(self, prices):
+        prices = np.concatenate([self.unpaired, np.asarray(prices, dtype=float)])
+        paired = len(prices) - len(prices) % 2
+        self.pairs.update(prices[:paired].reshape(-1, 2).mean(axis=1))
+        self.unpaired = prices[paired:]
+        return self
+
+    def merge(self, other):  # of a following shard, starting with a pair
+        self.pairs.merge(other.pairs)
+        self.unpaired = other.unpaired
+        return self
+
+    @property
+    def standard_error(self):
+        return self.pairs.standard_error
+
+
+class ReplicateStandardError:  # randomized QMC, by independent replicates
+    def __init__(self, replicates, start=0):
+        # the scenario with index i belongs to the replicate i % replicates
+        self.replicates = replicates
+        self.position = start  # index of the next scenario
+        self.sums = np.zeros(replicates)
+        self.counts = np.zeros(replicates)
+
+    def update(self, prices):
+        prices = np.asarray(prices, dtype=float).ravel()
+        replicate = (self.position + np.arange(len(prices))) % self.replicates
+        self.sums += np.bincount(replicate, prices, self.replicates)
+        self.counts += np.bincount(replicate, minlength=self.replicates)
+        self.position += len(prices)
+        return self
+
+    def merge(self, other):
+        self.sums += other.sums
+        self.counts += other.counts
+        self.position = max(self.position, other.position)
+        return self
+
+    @property
+    def standard_error(self):
+        # the mean of the replicate means is the estimate
+        means = self.sums[self.counts > 0] / self.counts[self.counts > 0]
+        if len(means) < 2:
+            return np.nan
+        return np.std(means, ddof=1) / np.sqrt(len(means))
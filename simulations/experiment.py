@@ -3,38 +3,28 @@ from pricing import PricingEngineWithProxyAndResidual
 from shocks import relative_shock
 from portfolio import *
 from shocks import danske_100, no_shock
+from experiment_grid import ExperimentGrid
 import pandas as pd
 
-baseline = Simulation()
-
-modified_pricing = baseline.clone().with_pricing_engine(
-    PricingEngineWithProxyAndResidual()
-)
-
 banks_minus100bps = relative_shock(
     NORDEA_TICK, 0.99
 )  # + relative_shock(DANSKE_TICK, 0.99)
 
-data = []
-for shock_name, shock in [
-    ("-", no_shock),
-    ("Danske Bank = 100", danske_100),
-    ("Banks -100bps", banks_minus100bps),
-]:
-    for model_name, model in [
-        ("Empty", Simulation.empty()),
-        ("Baseline", baseline),
-        ("Modified pricing", modified_pricing),
-    ]:
-        model = model.clone().with_shock(shock)
-        data.append(
-            dict(
-                model=model_name,
-                shock=shock_name,
-                mean_price=model.mean_price,
-                volatility=model.price_volatility,
-            )
-        )
+# Scenarios are generated once and every shock is priced by all models
+# in vectorized passes.
+grid = ExperimentGrid(
+    shocks=[
+        ("-", no_shock),
+        ("Danske Bank = 100", danske_100),
+        ("Banks -100bps", banks_minus100bps),
+    ],
+    pricing_engines=[
+        ("Empty", None),  # NaN rows, as Simulation.empty()
+        ("Baseline", default_pricing_engine()),
+        ("Modified pricing", PricingEngineWithProxyAndResidual()),
+    ],
+    portfolios=[("Default", default_portfolio())],
+)
 
-df = pd.DataFrame(data)
+df = grid.run()
 df.to_excel("experiment.xlsx")
@@ -0,0 +1,79 @@
+from simulation import *
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+
+def compiled(portfolio):
+    try:
+        return compile_portfolio(portfolio)
+    except NotImplementedError:
+        return portfolio  # price through the asset tree
+
+
+class ExperimentGrid:  # Builder - all shocks x pricing engines x portfolios
+    def __init__(
+        self,
+        shocks=None,
+        pricing_engines=None,
+        portfolios=None,
+        scenario_generator=None,
+        workers=None,
+    ):
+        # shocks, pricing engines and portfolios are lists of (name, object),
+        # a None pricing engine is an empty model without prices (NaN rows)
+        self.shocks = shocks or [("-", no_shock)]
+        self.pricing_engines = pricing_engines or [
+            ("Baseline", default_pricing_engine())
+        ]
+        self.portfolios = portfolios or [("Default", default_portfolio())]
+        self.scenario_generator = scenario_generator or default_scenario_generator()
+        self.workers = workers
+
+    def with_shock(self, name, shock):
+        self.shocks.append((name, shock))
+        return self
+
+    def with_pricing_engine(self, name, pricing_engine):
+        self.pricing_engines.append((name, pricing_engine))
+        return self
+
+    def with_portfolio(self, name, portfolio):
+        self.portfolios.append((name, portfolio))
+        return self
+
+    def model_name(self, portfolio_name, engine_name):
+        if len(self.portfolios) == 1:
+            return engine_name
+        return f"{portfolio_name}: {engine_name}"
+
+    def shock_rows(self, shock_name, shock, scenarios, count, portfolios):
+        # The shock is applied once and shared by all models
+        shocked = shock(dict(scenarios))
+        rows = []
+        for portfolio_name, portfolio in portfolios:
+            for engine_name, pricing_engine in self.pricing_engines:
+                statistics = PriceStatistics()
+                if pricing_engine is not None:  # None: no prices, NaN statistics
+                    prices = portfolio.price(shocked, pricing_engine)
+                    statistics.update(np.broadcast_to(prices, (count,)))
+                rows.append(
+                    dict(
+                        model=self.model_name(portfolio_name, engine_name),
+                        shock=shock_name,
+                        mean_price=statistics.mean,
+                        volatility=statistics.std,
+                    )
+                )
+        return rows
+
+    def run(self):
+        scenarios = ScenarioBlock.from_generator(self.scenario_generator)  # once
+        portfolios = [(name, compiled(p)) for name, p in self.portfolios]
+        # Shocks are independent; NumPy releases the GIL in the heavy parts,
+        # so threads work without pickling the (often local) shock functions.
+        with ThreadPoolExecutor(self.workers) as executor:
+            rows = executor.map(
+                lambda x: self.shock_rows(*x, scenarios, len(scenarios), portfolios),
+                self.shocks,
+            )
+            return pd.DataFrame([row for shock_rows in rows for row in shock_rows])
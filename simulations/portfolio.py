@@ -39,6 +39,12 @@ class Asset:
             for xx in x.descendants():
                 yield xx
 
+    def compile(self, plan, amount=1.0):
+        raise NotImplementedError(f"{self} can not be compiled into a pricing plan")
+
+    def greeks(self, scenario, pricing_engine):
+        return compile_portfolio(self).greeks(scenario, pricing_engine)
+
     def __str__(self):
         return self.__class__.__name__
 
@@ -50,8 +56,13 @@ class NullAsset(Asset):
     def volatility(self, scenario, pricing_engine):
         return 0.0
 
+    def compile(self, plan, amount=1.0):
+        pass
+
 
 class VanillaCallOption(Asset):
+    interest_rate_key = "EONIA"
+
     def __init__(self, strike, maturity, asset):
         self.strike = strike
         self.asset = asset
@@ -65,21 +76,29 @@ class VanillaCallOption(Asset):
         return [self.asset]
 
     def interest_rate(self, scenario):
-        return scenario["EONIA"]
+        return scenario[self.interest_rate_key]
 
-    def price(self, scenario, pricing_engine):
-        spot = self.asset.price(scenario, pricing_engine)
-        volatility = self.asset.volatility(scenario, pricing_engine)
-        return pricing_engine.vanilla_call_option_price(
+    def pricing_arguments(self, scenario, pricing_engine):
+        return dict(
             strike=self.strike,
             time_to_maturity=self.maturity - self.day(scenario),
-            spot_price=spot,
-            volatility=volatility,
+            spot_price=self.asset.price(scenario, pricing_engine),
+            volatility=self.asset.volatility(scenario, pricing_engine),
             interest_rate=self.interest_rate(scenario),
         )
 
-    def volatility(self, scenario, pricing_engine):
-        raise NotImplementedError("TBD")
+    def price(self, scenario, pricing_engine):
+        return pricing_engine.vanilla_call_option_price(
+            **self.pricing_arguments(scenario, pricing_engine)
+        )
+
+    def volatility(self, scenario, pricing_engine):  # vega, the option's exposure
+        return pricing_engine.vanilla_call_option_greeks(
+            **self.pricing_arguments(scenario, pricing_engine)
+        )["vega"]
+
+    def compile(self, plan, amount=1.0):
+        plan.add_option(amount, self)
 
     def as_dict(self):
         return dict(
@@ -113,6 +132,9 @@ class Equity(Asset):
     def volatility(self, scenario, pricing_engine):
         return pricing_engine.equity_volatility(scenario, self.ticker)
 
+    def compile(self, plan, amount=1.0):
+        plan.add_equity(amount, self.ticker)
+
     def as_dict(self):
         return dict(
             asset_type=self.__class__.__name__,
@@ -139,12 +161,15 @@ class Position(Asset):
     def price(self, scenario, pricing_engine):
         return self.amount * self.asset.price(scenario, pricing_engine)
 
-    def volatility(self, scenario):
+    def volatility(self, scenario, pricing_engine):
         return self.amount * self.asset.volatility(scenario, pricing_engine)
 
     def children(self):
         yield self.asset
 
+    def compile(self, plan, amount=1.0):
+        self.asset.compile(plan, amount * self.amount)
+
     def as_dict(self):
         return dict(
             asset_type=self.__class__.__name__,
@@ -186,6 +211,10 @@ class Portfolio(Asset):
     def children(self):
         return self.assets
 
+    def compile(self, plan, amount=1.0):
+        for x in self.assets:
+            x.compile(plan, amount)
+
     def as_dict(self):
         return dict(
             asset_type=self.__class__.__name__,
@@ -200,8 +229,359 @@ class Portfolio(Asset):
 
 
 class VanillaCallOptionDK(VanillaCallOption):
-    def interest_rate(self, scenario):
-        return scenario["DKKLIBOR-1W"]
+    interest_rate_key = "DKKLIBOR-1W"
+
+
+def group_sum(values, groups, count):  # sums the last axis by groups
+    result = np.zeros(values.shape[:-1] + (count,))
+    np.add.at(np.moveaxis(result, -1, 0), groups, np.moveaxis(values, -1, 0))
+    return result
+
+
+def stack_columns(values, shape, dtype=float):
+    if not len(values):
+        return np.zeros(shape + (0,), dtype=dtype)
+    return np.stack(
+        [np.broadcast_to(np.asarray(x, dtype=dtype), shape) for x in values], axis=-1
+    )
+
+
+def scenario_day(day):
+    # float32 scenarios are priced in float32, anything else in float64
+    day = np.asarray(day)
+    return day.astype(np.float32 if day.dtype == np.float32 else float, copy=False)
+
+
+class PortfolioPlan(Asset):  # Composite flattened into arrays, grouped by type
+    def __init__(self):
+        self.tickers = {}  # key -> index while building, list when frozen
+        self.rate_keys = {}
+        self.equity_amounts = []
+        self.equity_tickers = []
+        self.option_amounts = []
+        self.option_strikes = []
+        self.option_maturities = []
+        self.option_tickers = []
+        self.option_rate_keys = []
+
+    @staticmethod
+    def key_index(keys, key):
+        return keys.setdefault(key, len(keys))
+
+    def add_equity(self, amount, ticker):
+        self.equity_amounts.append(amount)
+        self.equity_tickers.append(self.key_index(self.tickers, ticker))
+
+    def add_option(self, amount, option):
+        if not isinstance(option.asset, Equity):
+            raise NotImplementedError(
+                f"Option on {option.asset} can not be compiled into a pricing plan"
+            )
+        self.option_amounts.append(amount)
+        self.option_strikes.append(option.strike)
+        self.option_maturities.append(option.maturity)
+        self.option_tickers.append(self.key_index(self.tickers, option.asset.ticker))
+        self.option_rate_keys.append(
+            self.key_index(self.rate_keys, option.interest_rate_key)
+        )
+
+    def freeze(self):
+        self.tickers = list(self.tickers)
+        self.rate_keys = list(self.rate_keys)
+        self.equity_amounts = np.array(self.equity_amounts, dtype=float)
+        self.equity_tickers = np.array(self.equity_tickers, dtype=int)
+        self.option_amounts = np.array(self.option_amounts, dtype=float)
+        self.option_strikes = np.array(self.option_strikes, dtype=float)
+        self.option_maturities = np.array(self.option_maturities, dtype=float)
+        self.option_tickers = np.array(self.option_tickers, dtype=int)
+        self.option_rate_keys = np.array(self.option_rate_keys, dtype=int)
+        self.equity_exposure = np.bincount(
+            self.equity_tickers,
+            weights=self.equity_amounts,
+            minlength=len(self.tickers),
+        )
+        return self
+
+    def scenario_keys(self, pricing_engine):  # read by the plan
+        keys = ["DAY", *self.rate_keys]
+        for ticker in self.tickers:
+            keys += pricing_engine.equity_dependencies(ticker)
+            keys += pricing_engine.volatility_dependencies(ticker)
+        return keys
+
+    def batch_day(self, scenario, pricing_engine, dtype=None):
+        # DAY broadcast to the batch shape of all the columns read, e.g. a
+        # scalar DAY (shocked or from a single dict) with vector prices.
+        day = scenario_day(self.day(scenario))
+        if dtype is not None:
+            day = day.astype(dtype, copy=False)
+        shape = np.broadcast_shapes(
+            *(
+                np.shape(scenario[key])
+                for key in self.scenario_keys(pricing_engine)
+                if key in scenario
+            )
+        )
+        return np.broadcast_to(day, shape)
+
+    def ticker_columns(self, function, scenario, tickers, shape, dtype=float):
+        return stack_columns(
+            [function(scenario, self.tickers[t]) for t in tickers], shape, dtype
+        )
+
+    def option_arguments(self, scenario, pricing_engine, day, spots, options):
+        # vanilla_call_option_price arguments of the selected options
+        tickers, columns = np.unique(self.option_tickers[options], return_inverse=True)
+        volatilities = self.ticker_columns(
+            pricing_engine.equity_volatility, scenario, tickers, day.shape, day.dtype
+        )
+        rate_keys, rate_columns = np.unique(
+            self.option_rate_keys[options], return_inverse=True
+        )
+        rates = stack_columns(
+            [scenario[self.rate_keys[k]] for k in rate_keys], day.shape, day.dtype
+        )
+        return dict(
+            strike=self.option_strikes[options].astype(day.dtype),
+            time_to_maturity=self.option_maturities[options].astype(day.dtype)
+            - day[..., None],
+            spot_price=spots,
+            volatility=volatilities[..., columns],
+            interest_rate=rates[..., rate_columns],
+        )
+
+    def option_prices(self, scenario, pricing_engine, day, spots, options=None):
+        # spots are the underlying prices of the selected options
+        if options is None:
+            options = np.arange(len(self.option_amounts))
+        prices = pricing_engine.vanilla_call_option_price(
+            **self.option_arguments(scenario, pricing_engine, day, spots, options)
+        )
+        return np.broadcast_to(prices, day.shape + options.shape)
+
+    def price(self, scenario, pricing_engine):
+        # scenario is anything with columns accessible as scenario[key]:
+        # a ScenarioBlock, a dict of arrays, a DataFrame or a single dict
+        # scenario.
+        day = self.batch_day(scenario, pricing_engine)
+        spots = self.ticker_columns(
+            pricing_engine.equity_price,
+            scenario,
+            range(len(self.tickers)),
+            day.shape,
+            day.dtype,
+        )
+        value = spots @ self.equity_exposure  # float64 sums
+        if len(self.option_amounts):
+            options = np.arange(len(self.option_amounts))
+            # priced and summed by the engine, which may fuse the two
+            value = value + pricing_engine.vanilla_call_option_value(
+                amounts=self.option_amounts,
+                **self.option_arguments(
+                    scenario,
+                    pricing_engine,
+                    day,
+                    spots[..., self.option_tickers],
+                    options,
+                ),
+            )
+        return value
+
+    @property
+    def position_count(self):
+        return len(self.equity_amounts) + len(self.option_amounts)
+
+    def position_prices(self, scenario, pricing_engine, positions=None):
+        # Prices of the flattened positions (equities first, then options),
+        # optionally only of the selected ones, in ascending order.
+        day = self.batch_day(scenario, pricing_engine)
+        if positions is None:
+            positions = np.arange(self.position_count)
+        positions = np.unique(positions)
+        equity_count = len(self.equity_amounts)
+        equities = positions[positions < equity_count]
+        options = positions[positions >= equity_count] - equity_count
+        tickers, columns = np.unique(
+            np.concatenate(
+                [self.equity_tickers[equities], self.option_tickers[options]]
+            ),
+            return_inverse=True,
+        )
+        spots = self.ticker_columns(
+            pricing_engine.equity_price, scenario, tickers, day.shape, day.dtype
+        )[..., columns]
+        equity_prices = spots[..., : len(equities)] * self.equity_amounts[
+            equities
+        ].astype(day.dtype)
+        option_prices = self.option_prices(
+            scenario, pricing_engine, day, spots[..., len(equities) :], options
+        ) * self.option_amounts[options].astype(day.dtype)
+        return np.concatenate([equity_prices, option_prices], axis=-1)
+
+    def risk_factor_values(self, scenario, pricing_engine, day):
+        # spots and volatilities by ticker, rates by rate key and the day
+        all_tickers = range(len(self.tickers))
+        return np.concatenate(
+            [
+                self.ticker_columns(
+                    pricing_engine.equity_price, scenario, all_tickers, day.shape
+                ),
+                self.ticker_columns(
+                    pricing_engine.equity_volatility, scenario, all_tickers, day.shape
+                ),
+                stack_columns([scenario[k] for k in self.rate_keys], day.shape),
+                day[..., None],
+            ],
+            axis=-1,
+        )
+
+    def risk_factor_greeks(self, scenario, pricing_engine):
+        # delta, gamma and vega by ticker, rho by rate key and theta
+        day = self.batch_day(scenario, pricing_engine, float)
+        values = self.risk_factor_values(scenario, pricing_engine, day)
+        ticker_count = len(self.tickers)
+        spots = values[..., :ticker_count]
+        volatilities = values[..., ticker_count : 2 * ticker_count]
+        rates = values[..., 2 * ticker_count : -1]
+        greeks = pricing_engine.vanilla_call_option_greeks(
+            strike=self.option_strikes,
+            time_to_maturity=self.option_maturities - day[..., None],
+            spot_price=spots[..., self.option_tickers],
+            volatility=volatilities[..., self.option_tickers],
+            interest_rate=rates[..., self.option_rate_keys],
+        )
+        shape = day.shape + self.option_amounts.shape
+        greeks = {
+            name: np.broadcast_to(x, shape) * self.option_amounts
+            for name, x in greeks.items()
+        }
+        return dict(
+            delta=self.equity_exposure
+            + group_sum(greeks["delta"], self.option_tickers, ticker_count),
+            gamma=group_sum(greeks["gamma"], self.option_tickers, ticker_count),
+            vega=group_sum(greeks["vega"], self.option_tickers, ticker_count),
+            rho=group_sum(greeks["rho"], self.option_rate_keys, len(self.rate_keys)),
+            theta=greeks["theta"].sum(axis=-1),
+        )
+
+    def greeks(self, scenario, pricing_engine):
+        # Sensitivities by risk factor: delta and gamma by ticker, vega by
+        # volatility key, rho by rate key and theta (by DAY) for the portfolio.
+        greeks = self.risk_factor_greeks(scenario, pricing_engine)
+        delta, gamma, vega, rho = (greeks[x] for x in ["delta", "gamma", "vega", "rho"])
+        volatility_keys = {}
+        for i, ticker in enumerate(self.tickers):
+            for key in pricing_engine.volatility_dependencies(ticker):
+                volatility_keys[key] = volatility_keys.get(key, 0.0) + vega[..., i]
+        return dict(
+            delta={t: delta[..., i] for i, t in enumerate(self.tickers)},
+            gamma={t: gamma[..., i] for i, t in enumerate(self.tickers)},
+            vega=volatility_keys,
+            rho={k: rho[..., i] for i, k in enumerate(self.rate_keys)},
+            theta=greeks["theta"],
+        )
+
+    def price_block(self, block, index, pricing_engine):
+        return self.price(
+            {key: block[:, i] for key, i in index.items()}, pricing_engine
+        )
+
+
+def compile_portfolio(portfolio):  # one walk over the tree
+    plan = PortfolioPlan()
+    portfolio.compile(plan)
+    return plan.freeze()
+
+
+class TaylorApproximation(Asset):  # Proxy - delta-gamma-vega approximation
+    # Greeks are evaluated once at the base scenario (for the pricing engine
+    # used first), every scenario is then priced by a Taylor expansion in
+    # spots, volatilities, rates and the day.
+    def __init__(self, plan, base_scenario, order=2):
+        self.plan = plan
+        self.base_scenario = base_scenario
+        self.order = order
+        self.pricing_engine = None
+
+    def expand(self, pricing_engine):
+        plan = self.plan
+        day = plan.batch_day(self.base_scenario, pricing_engine, float)
+        self.base_price = plan.price(self.base_scenario, pricing_engine)
+        self.base_values = plan.risk_factor_values(
+            self.base_scenario, pricing_engine, day
+        )
+        greeks = plan.risk_factor_greeks(self.base_scenario, pricing_engine)
+        self.first_order = np.concatenate(
+            [greeks["delta"], greeks["vega"], greeks["rho"], [greeks["theta"]]]
+        )
+        self.second_order = np.zeros_like(self.first_order)
+        self.second_order[: len(plan.tickers)] = greeks["gamma"]
+        self.pricing_engine = pricing_engine
+
+    def price(self, scenario, pricing_engine):
+        if self.pricing_engine is not pricing_engine:
+            self.expand(pricing_engine)
+        day = self.plan.batch_day(scenario, pricing_engine, float)
+        change = (
+            self.plan.risk_factor_values(scenario, pricing_engine, day)
+            - self.base_values
+        )
+        value = self.base_price + change @ self.first_order
+        if self.order >= 2:
+            value = value + 0.5 * (change ** 2) @ self.second_order
+        return value
+
+
+class RiskFactorIndex:  # scenario key -> positions of the plan depending on it
+    def __init__(self, plan, pricing_engine):
+        self.plan = plan
+        positions = {}
+
+        def add(keys, position):
+            for key in keys:
+                positions.setdefault(key, []).append(position)
+
+        for i, t in enumerate(plan.equity_tickers):
+            add(pricing_engine.equity_dependencies(plan.tickers[t]), i)
+        equity_count = len(plan.equity_amounts)
+        for i, (t, r) in enumerate(zip(plan.option_tickers, plan.option_rate_keys)):
+            ticker = plan.tickers[t]
+            add(pricing_engine.equity_dependencies(ticker), equity_count + i)
+            add(pricing_engine.volatility_dependencies(ticker), equity_count + i)
+            add([plan.rate_keys[r], "DAY"], equity_count + i)
+        self.positions = {
+            key: np.unique(np.array(x, dtype=int)) for key, x in positions.items()
+        }
+
+    def keys(self):
+        return self.positions.keys()
+
+    def affected(self, changed_keys):
+        found = [self.positions[k] for k in changed_keys if k in self.positions]
+        if not found:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.concatenate(found))
+
+    def reprice(self, position_prices, scenario, pricing_engine, changed_keys):
+        # position_prices are the base prices from plan.position_prices,
+        # only the positions depending on the changed keys are recalculated.
+        positions = self.affected(changed_keys)
+        prices = np.array(position_prices, dtype=float)
+        if len(positions):
+            prices[..., positions] = self.plan.position_prices(
+                scenario, pricing_engine, positions
+            )
+        return prices
+
+
+def risk_factor_index(portfolio, pricing_engine):
+    return RiskFactorIndex(compile_portfolio(portfolio), pricing_engine)
+
+
+def required_scenario_keys(portfolio, pricing_engine):
+    # the scenario columns needed to price the portfolio
+    keys = risk_factor_index(portfolio, pricing_engine).keys()
+    return sorted(set(keys) | {"DAY"})
 
 
 # Prototypes
@@ -1,7 +1,62 @@
 # Composite pattern - Option
+import math
+import multiprocessing
+from collections import OrderedDict
 import numpy as np
 import scipy.stats as si
+from scipy.special import ndtr
 from config import *
+from scenarios import CHUNK_SIZE, SCENARIO_INDEX_KEY
+
+try:
+    import numba
+except ImportError:  # optional, NumbaPricingEngine falls back to NumPy
+    numba = None
+
+SQRT1_2 = math.sqrt(0.5)
+SQRT_2PI = math.sqrt(2 * math.pi)
+TILE_ROWS = 64  # scenarios per tile in the numba kernels
+
+
+def option_dtype(*arrays):  # float32 only if all the arguments are
+    float32 = all(np.asarray(x).dtype == np.float32 for x in arrays)
+    return np.dtype(np.float32 if float32 else np.float64)
+
+
+def black_scholes_call(
+    strike,
+    time_to_maturity,
+    spot_price,
+    volatility,
+    interest_rate,
+    out=None,
+    dtype=None,
+):
+    # Vectorized Black-Scholes call price. The shared subexpressions are
+    # computed once and ndtr avoids the per call overhead of scipy.stats.norm.
+    # dtype=np.float32 evaluates the kernel in single precision, out= is an
+    # optional preallocated result buffer. By default the precision follows
+    # the arguments (or out).
+    if dtype is None and out is not None:
+        dtype = out.dtype
+    elif dtype is None:
+        dtype = option_dtype(
+            strike, time_to_maturity, spot_price, volatility, interest_rate
+        )
+    S = np.asarray(spot_price, dtype=dtype)
+    K = np.asarray(strike, dtype=dtype)
+    T = np.asarray(time_to_maturity, dtype=dtype)
+    r = np.asarray(interest_rate, dtype=dtype)
+    sigma = np.asarray(volatility, dtype=dtype)
+
+    sigma_sqrt_T = sigma * np.sqrt(T)
+    d1 = (np.log(S / K) + (r + 0.5 * sigma * sigma) * T) / sigma_sqrt_T
+    d2 = d1 - sigma_sqrt_T
+    discounted_strike = K * np.exp(-r * T)
+
+    price = np.multiply(S, ndtr(d1), out=out)
+    price -= discounted_strike * ndtr(d2)
+    return price if out is not None or price.ndim else price[()]
 
 
 class PricingEngine:  # Bridge, Strategy
@@ -11,42 +66,244 @@ class PricingEngine:  # Bridge, Strategy
         return scenario[ticker]
 
     def equity_volatility(self, scenario, ticker):
-        return scenario.get(ticker + "_volatility", self.default_equity_volatility)
+        # dicts, pandas rows and DataFrames, and ScenarioBlocks all support "in"
+        key = ticker + "_volatility"
+        if key in scenario:
+            return scenario[key]
+        return self.default_equity_volatility
+
+    def equity_dependencies(self, ticker):  # scenario keys used by equity_price
+        return [ticker]
+
+    def volatility_dependencies(self, ticker):
+        return [ticker + "_volatility"]
 
     def vanilla_call_option_price(
         self, strike, time_to_maturity, spot_price, volatility, interest_rate
     ):
-        # from https://aaronschlegel.me/black-scholes-formula-python.html
+        return black_scholes_call(
+            strike, time_to_maturity, spot_price, volatility, interest_rate
+        )
 
-        # S: spot price
+    def vanilla_call_option_value(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate, amounts
+    ):
+        # Sum of the option prices weighted by amounts over the last axis
+        return (
+            self.vanilla_call_option_price(
+                strike, time_to_maturity, spot_price, volatility, interest_rate
+            )
+            @ amounts
+        )
+
+    def vanilla_call_option_greeks(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate
+    ):
+        # Black-Scholes sensitivities, d1 and d2 are evaluated once.
+        # theta is the derivative with respect to the day (i.e. -d/dT).
         S = spot_price
-        # K: strike price
         K = strike
-
-        # T: time to maturity
         T = time_to_maturity
-
-        # r: interest rate
         r = interest_rate
-
-        # sigma: volatility of underlying asset
         sigma = volatility
 
-        d1 = (np.log(S / K) + (r + 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
-        d2 = (np.log(S / K) + (r - 0.5 * sigma ** 2) * T) / (sigma * np.sqrt(T))
+        sqrt_T = np.sqrt(T)
+        sigma_sqrt_T = sigma * sqrt_T
+        d1 = (np.log(S / K) + (r + 0.5 * sigma ** 2) * T) / sigma_sqrt_T
+        d2 = d1 - sigma_sqrt_T
+        pdf_d1 = np.exp(-0.5 * d1 * d1) / SQRT_2PI
+        discounted_strike = K * np.exp(-r * T)
+        cdf_d2 = ndtr(d2)
 
-        return S * si.norm.cdf(d1, 0.0, 1.0) - K * np.exp(-r * T) * si.norm.cdf(
-            d2, 0.0, 1.0
+        return dict(
+            delta=ndtr(d1),
+            gamma=pdf_d1 / (S * sigma_sqrt_T),
+            vega=S * pdf_d1 * sqrt_T,
+            theta=-S * pdf_d1 * sigma / (2 * sqrt_T) - r * discounted_strike * cdf_d2,
+            rho=T * discounted_strike * cdf_d2,
         )
 
 
 class PricingEngineWithProxyAndResidual(PricingEngine):
+    # The residuals are a counter based stream by scenario index, like the
+    # Monte Carlo scenarios. They are drawn a chunk at a time and every
+    # position and shocked copy of a scenario sees the same residual.
+    residual_scale = 2.123
+    max_residual_chunks = 64
+
+    def __init__(self, seed=2123):
+        self.seed = seed
+        self.residual_chunks = OrderedDict()  # LRU, chunk -> residuals
+        # scenarios without the index, e.g. hand-built dicts, draw from
+        # this stream (apart from the chunks), the last draw is reused
+        self.random = np.random.Generator(
+            np.random.Philox(key=seed, counter=[0, 0, 0, 1])
+        )
+        self.last_residuals = None  # (scenario, residuals)
+
+    def residual_chunk(self, chunk):
+        if chunk in self.residual_chunks:
+            self.residual_chunks.move_to_end(chunk)
+            return self.residual_chunks[chunk]
+        random = np.random.Generator(
+            np.random.Philox(key=self.seed, counter=[0, chunk, 0, 0])
+        )
+        residuals = random.normal(scale=self.residual_scale, size=CHUNK_SIZE)
+        self.residual_chunks[chunk] = residuals
+        if len(self.residual_chunks) > self.max_residual_chunks:
+            self.residual_chunks.popitem(last=False)
+        return residuals
+
+    def residuals(self, scenario, shape=()):
+        # Monte Carlo scenarios and scenario files have the index column.
+        # A NaN index is priced by the proxy alone, e.g. the mean scenario.
+        if SCENARIO_INDEX_KEY not in scenario:
+            return self.unindexed_residuals(scenario, shape)
+        index = np.asarray(scenario[SCENARIO_INDEX_KEY], dtype=float)
+        proxy_only = np.isnan(index)
+        index = np.where(proxy_only, 0, index).astype(np.int64)
+        chunks, inverse = np.unique(index // CHUNK_SIZE, return_inverse=True)
+        table = np.stack([self.residual_chunk(int(c)) for c in chunks])
+        residuals = table[inverse.reshape(index.shape), index % CHUNK_SIZE]
+        return np.where(proxy_only, 0.0, residuals)
+
+    def unindexed_residuals(self, scenario, shape):
+        # One draw per scenario (block), every position pricing the same
+        # scenario object sees the same residuals.
+        if self.last_residuals is None or self.last_residuals[0] is not scenario:
+            residuals = self.random.normal(scale=self.residual_scale, size=shape)
+            self.last_residuals = (scenario, residuals)
+        return self.last_residuals[1]
+
     def equity_price(self, scenario, ticker):
         if ticker == "CPH:DANSKE":
-            residual = np.random.normal(scale=2.123)
-            return scenario["CPH:NDA-DK"] * 106.1 / 67.63 + residual
+            proxy = scenario["CPH:NDA-DK"]
+            return proxy * 106.1 / 67.63 + self.residuals(scenario, np.shape(proxy))
         return scenario[ticker]
 
+    def equity_dependencies(self, ticker):
+        if ticker == "CPH:DANSKE":
+            return ["CPH:NDA-DK", SCENARIO_INDEX_KEY]  # residual by scenario
+        return [ticker]
+
+
+if numba is not None:
+
+    @numba.njit(inline="always")
+    def numba_call_price(strike, time_to_maturity, spot, volatility, rate):
+        sigma_sqrt_T = volatility * np.sqrt(time_to_maturity)
+        d1 = (
+            np.log(spot / strike)
+            + (rate + 0.5 * volatility * volatility) * time_to_maturity
+        ) / sigma_sqrt_T
+        d2 = d1 - sigma_sqrt_T
+        # normal cdf, like ndtr
+        return 0.5 * spot * math.erfc(-d1 * SQRT1_2) - 0.5 * strike * np.exp(
+            -rate * time_to_maturity
+        ) * math.erfc(-d2 * SQRT1_2)
+
+    # Rows are processed in tiles, so the loops are cache friendly for
+    # both C and Fortran ordered (e.g. stacked column) arrays.
+    def numba_call_prices(strike, time_to_maturity, spot, volatility, rate, out):
+        rows, columns = out.shape
+        for tile in numba.prange((rows + TILE_ROWS - 1) // TILE_ROWS):
+            for j in range(columns):
+                for i in range(tile * TILE_ROWS, min(rows, (tile + 1) * TILE_ROWS)):
+                    out[i, j] = numba_call_price(
+                        strike[i, j],
+                        time_to_maturity[i, j],
+                        spot[i, j],
+                        volatility[i, j],
+                        rate[i, j],
+                    )
+        return out
+
+    def numba_call_value(strike, time_to_maturity, spot, volatility, rate, amounts):
+        # pricing and summation fused, no temporary price matrix
+        rows, columns = spot.shape
+        value = np.zeros(rows)
+        for tile in numba.prange((rows + TILE_ROWS - 1) // TILE_ROWS):
+            for j in range(columns):
+                for i in range(tile * TILE_ROWS, min(rows, (tile + 1) * TILE_ROWS)):
+                    value[i] += amounts[j] * numba_call_price(
+                        strike[i, j],
+                        time_to_maturity[i, j],
+                        spot[i, j],
+                        volatility[i, j],
+                        rate[i, j],
+                    )
+        return value
+
+    # Worker processes (e.g. of ParallelBatchSimulation) already use all
+    # cores and must not start a threading layer after the fork, they
+    # get the serial kernels. Only the parallel ones are cached on disk,
+    # the cache does not tell the two apart.
+    NUMBA_KERNELS = {
+        parallel: (
+            numba.njit(parallel=parallel, cache=parallel)(numba_call_prices),
+            numba.njit(parallel=parallel, cache=parallel)(numba_call_value),
+        )
+        for parallel in [True, False]
+    }
+
+
+def fork_safe():  # False once numba runs parallel kernels on tbb
+    # tbb hangs processes forked after it has started, even if they do not
+    # use it. The layer is chosen by numba at the first parallel kernel.
+    if numba is None:
+        return True
+    try:
+        return numba.threading_layer() != "tbb"
+    except ValueError:  # no parallel kernel has run yet
+        return True
+
+
+def option_matrices(*arrays):
+    # broadcast the option arguments to (scenarios, options) without copies
+    dtype = option_dtype(*arrays)
+    arrays = [np.asarray(x, dtype=dtype) for x in arrays]
+    shape = np.broadcast_shapes(*[x.shape for x in arrays])
+    matrix = (-1, shape[-1] if shape else 1)
+    return [np.broadcast_to(x, shape).reshape(matrix) for x in arrays], shape
+
+
+class NumbaPricingEngine(PricingEngine):  # JIT compiled Black-Scholes
+    # Works like PricingEngine (which it falls back to without numba), but
+    # the options are priced by compiled parallel kernels and the plan
+    # summation over options is fused into the pricing loop.
+
+    @staticmethod
+    def kernels():
+        return NUMBA_KERNELS[multiprocessing.parent_process() is None]
+
+    def vanilla_call_option_price(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate
+    ):
+        if numba is None:
+            return super().vanilla_call_option_price(
+                strike, time_to_maturity, spot_price, volatility, interest_rate
+            )
+        arrays, shape = option_matrices(
+            strike, time_to_maturity, spot_price, volatility, interest_rate
+        )
+        call_prices, call_value = self.kernels()
+        prices = call_prices(*arrays, np.empty_like(arrays[0]))
+        return prices.reshape(shape) if shape else prices[0, 0]
+
+    def vanilla_call_option_value(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate, amounts
+    ):
+        if numba is None:
+            return super().vanilla_call_option_value(
+                strike, time_to_maturity, spot_price, volatility, interest_rate, amounts
+            )
+        arrays, shape = option_matrices(
+            strike, time_to_maturity, spot_price, volatility, interest_rate
+        )
+        call_prices, call_value = self.kernels()
+        value = call_value(*arrays, np.asarray(amounts, dtype=float))
+        return value.reshape(shape[:-1]) if len(shape) > 1 else value[0]
+
 
 class NullPricingEngine:
     def equity_price(self, scenario, ticker):
@@ -55,11 +312,180 @@ class NullPricingEngine:
     def equity_volatility(self, scenario, ticker):
         return 0
 
+    def equity_dependencies(self, ticker):
+        return []
+
+    def volatility_dependencies(self, ticker):
+        return []
+
     def vanilla_call_option_price(
         self, strike, time_to_maturity, spot_price, volatility, interest_rate
     ):
         return 0
 
+    def vanilla_call_option_value(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate, amounts
+    ):
+        return 0
+
+    def vanilla_call_option_greeks(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate
+    ):
+        return dict(delta=0, gamma=0, vega=0, theta=0, rho=0)
+
+
+class CachingPricingEngine:  # Decorator - memoizes option prices
+    def __init__(self, pricing_engine=None, maxsize=100000):
+        self.pricing_engine = pricing_engine or PricingEngine()
+        self.maxsize = maxsize
+        self.prices = OrderedDict()  # LRU of scalar argument tuples
+        self.hits = 0  # lookups served from the LRU
+        self.misses = 0  # priced by the decorated engine
+        self.duplicates = 0  # repeated rows within a vectorized call
+
+    def equity_price(self, scenario, ticker):
+        return self.pricing_engine.equity_price(scenario, ticker)
+
+    def equity_volatility(self, scenario, ticker):
+        return self.pricing_engine.equity_volatility(scenario, ticker)
+
+    def equity_dependencies(self, ticker):
+        return self.pricing_engine.equity_dependencies(ticker)
+
+    def volatility_dependencies(self, ticker):
+        return self.pricing_engine.volatility_dependencies(ticker)
+
+    def cached_price(self, arguments):
+        if arguments in self.prices:
+            self.hits += 1
+            self.prices.move_to_end(arguments)
+            return self.prices[arguments]
+        self.misses += 1
+        return self.store(
+            arguments, self.pricing_engine.vanilla_call_option_price(*arguments)
+        )
+
+    def store(self, arguments, price):
+        self.prices[arguments] = price
+        if len(self.prices) > self.maxsize:
+            self.prices.popitem(last=False)
+        return price
+
+    def vanilla_call_option_price(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate
+    ):
+        arguments = (strike, time_to_maturity, spot_price, volatility, interest_rate)
+        if all(np.ndim(x) == 0 for x in arguments):
+            return self.cached_price(tuple(float(x) for x in arguments))
+        # Vectorized - the distinct argument rows are looked up in the LRU,
+        # the missing ones are priced in one call
+        shape = np.broadcast_shapes(*[np.shape(x) for x in arguments])
+        rows = np.stack(
+            [
+                np.broadcast_to(np.asarray(x, dtype=float), shape).ravel()
+                for x in arguments
+            ],
+            axis=1,
+        )
+        # rows compared as raw bytes, much faster than np.unique(axis=0)
+        unique, inverse = np.unique(
+            rows.view(np.dtype((np.void, rows.itemsize * len(arguments)))).ravel(),
+            return_inverse=True,
+        )
+        unique = unique.view(float).reshape(-1, len(arguments))
+        self.duplicates += len(rows) - len(unique)
+        keys = [tuple(row) for row in unique.tolist()]
+        prices = np.empty(len(keys))
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.prices:
+                self.prices.move_to_end(key)
+                prices[i] = self.prices[key]
+            else:
+                missing.append(i)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            missing_prices = np.broadcast_to(
+                self.pricing_engine.vanilla_call_option_price(*unique[missing].T),
+                (len(missing),),
+            )
+            prices[missing] = missing_prices
+            for i, price in zip(missing, missing_prices.tolist()):
+                self.store(keys[i], price)
+        return prices[inverse.ravel()].reshape(shape)
+
+    def vanilla_call_option_value(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate, amounts
+    ):
+        return (
+            self.vanilla_call_option_price(
+                strike, time_to_maturity, spot_price, volatility, interest_rate
+            )
+            @ amounts
+        )
+
+    def vanilla_call_option_greeks(
+        self, strike, time_to_maturity, spot_price, volatility, interest_rate
+    ):
+        return self.pricing_engine.vanilla_call_option_greeks(
+            strike, time_to_maturity, spot_price, volatility, interest_rate
+        )
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        self.prices.clear()
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+
 
 def default_pricing_engine():
     return eval(config()["pricing_engine"])()
+
+
+if __name__ == "__main__":
+    from timer import Timer
+
+    def reference_call_price(strike, time_to_maturity, spot, volatility, rate):
+        # the previous scipy.stats.norm implementation, for comparison
+        d1 = (
+            np.log(spot / strike) + (rate + 0.5 * volatility ** 2) * time_to_maturity
+        ) / (volatility * np.sqrt(time_to_maturity))
+        d2 = (
+            np.log(spot / strike) + (rate - 0.5 * volatility ** 2) * time_to_maturity
+        ) / (volatility * np.sqrt(time_to_maturity))
+        return spot * si.norm.cdf(d1, 0.0, 1.0) - strike * np.exp(
+            -rate * time_to_maturity
+        ) * si.norm.cdf(d2, 0.0, 1.0)
+
+    random = np.random.default_rng(123)
+    for n in [1, 1000, 1000000]:
+        repeat = max(1, 1000000 // (n * 10))
+        args = (
+            random.uniform(50, 150, n),
+            random.uniform(10, 300, n),
+            random.uniform(50, 150, n),
+            random.uniform(0.1, 1.0, n),
+            random.uniform(-0.01, 0.05, n),
+        )
+        out = np.empty(n)
+        out32 = np.empty(n, dtype=np.float32)
+        with Timer(f"scipy.stats.norm, {n} options x {repeat}"):
+            for i in range(repeat):
+                expected = reference_call_price(*args)
+        with Timer(f"black_scholes_call, {n} options x {repeat}"):
+            for i in range(repeat):
+                black_scholes_call(*args, out=out)
+        with Timer(f"black_scholes_call float32, {n} options x {repeat}"):
+            for i in range(repeat):
+                black_scholes_call(*args, out=out32)
+        print(
+            "max abs difference float64:",
+            np.abs(out - expected).max(),
+            "float32:",
+            np.abs(out32 - expected).max(),
+        )
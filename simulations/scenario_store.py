@@ -0,0 +1,116 @@
+import numpy as np
+import yaml
+from pathlib import Path
+from scenarios import *
+
+
+class ScenarioStore:  # Scenario block on disk, memory-mapped when opened
+    def __init__(self, path):
+        path = Path(path)
+        self.data_path = path.with_suffix(".npy")
+        self.header_path = path.with_suffix(".yaml")
+        self.cached_header = None
+
+    def exists(self):
+        return self.data_path.exists() and self.header_path.exists()
+
+    def header(self):  # read once
+        if self.cached_header is None:
+            with self.header_path.open() as f:
+                self.cached_header = yaml.safe_load(f)
+        return self.cached_header
+
+    def write(self, block, index, fingerprint=None):
+        array = np.lib.format.open_memmap(
+            self.data_path, mode="w+", dtype=block.dtype, shape=block.shape
+        )
+        array[:] = block
+        array.flush()
+        del array
+        # header is written last, a store without it is incomplete
+        header = dict(
+            keys=list(index), fingerprint=fingerprint, version=SCENARIO_STREAM_VERSION
+        )
+        with self.header_path.open("w") as f:
+            yaml.safe_dump(header, f)
+        self.cached_header = header
+        return self
+
+    def open(self):  # zero-copy
+        block = np.load(self.data_path, mmap_mode="r")
+        index = {key: i for i, key in enumerate(self.header()["keys"])}
+        return block, index
+
+    def matches(self, fingerprint):
+        if not self.exists():
+            return False
+        # stores of another (or before any) stream version are stale
+        header = self.header()
+        return (
+            header.get("version") == SCENARIO_STREAM_VERSION
+            and header.get("fingerprint") == fingerprint
+        )
+
+
+class StoredMonteCarloScenarios(MonteCarloScenarios):
+    # Generates the block on the first use, later runs (and worker processes)
+    # open the same file. The scenario fingerprint and the stream version in
+    # the header detect a stale store.
+    def __init__(
+        self,
+        path,
+        mean_scenario,
+        covariance,
+        keys=None,
+        seed=123,
+        count=None,
+        method="random",
+        dtype=np.float64,
+    ):
+        super().__init__(mean_scenario, covariance, keys, seed, count, method, dtype)
+        if not count:
+            raise Exception("Stored Monte Carlo scenarios need a scenario count")
+        self.path = path
+        self.opened = None
+
+    def prepare(self):
+        store = ScenarioStore(self.path)
+        # the scenario_fingerprint of the parameters is in the header
+        fingerprint = self.fingerprint()
+        if not store.matches(fingerprint):
+            block, index = monte_carlo_scenario_block(
+                self.mean_scenario,
+                self.covariance,
+                self.keys,
+                self.count,
+                self.seed,
+                self.method,
+                self.dtype,
+            )
+            store.write(block, index, fingerprint)
+        self.opened = store.open()
+        return store
+
+    def open(self):  # the block and index, opened once
+        if self.opened is None:
+            self.prepare()
+        return self.opened
+
+    def __getstate__(self):  # worker processes open the store themselves
+        state = super().__getstate__()
+        state["opened"] = None
+        return state
+
+    def block(self):
+        return self.open()
+
+    def blocks(self, block_size=CHUNK_SIZE):  # ranges of the stored block
+        self.open()
+        yield from super().blocks(block_size)
+
+    def shard(self, shard, start, stop):
+        if self.opened is None:  # prepared by the parent process
+            self.opened = ScenarioStore(self.path).open()
+        block, index = self.opened
+        # shards are row ranges of the stored block
+        return block[start:stop], index
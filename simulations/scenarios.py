@@ -1,61 +1,733 @@
 import numpy as np
-from scipy.stats import multivariate_normal
+from scipy.stats import norm, qmc
 from itertools import islice
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import copy
+import warnings
 import pandas as pd
 from config import *
+from accumulators import AntitheticStandardError, ReplicateStandardError
 
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional, needed for Parquet and Feather scenario files
+    pyarrow = None
 
-def monte_carlo_scenarios(mean_scenario, covariance, keys=None, seed=123):
+
+def scenario_keys(mean_scenario, keys=None):
     if keys is None:
-        keys = sorted(mean_scenario.keys())
-    else:
-        missing = [k for k in keys if k not in mean_scenario]
-        if missing:
-            raise Exception(f"Missing keys in mean scenario: {missing}")
-        keys = keys
-    mean = np.array([mean_scenario[key] for key in keys])
-    random = np.random.RandomState(seed)
-    i = 0
+        return sorted(mean_scenario.keys())
+    missing = [k for k in keys if k not in mean_scenario]
+    if missing:
+        raise Exception(f"Missing keys in mean scenario: {missing}")
+    return keys
+
+
+SAMPLING_METHODS = ["random", "antithetic", "sobol"]
+CHUNK_SIZE = 1024  # scenarios per Philox counter value
+SOBOL_REPLICATES = 16  # independent scramblings, give the standard error
+# Version of the generated scenario streams, to be increased whenever the
+# same parameters give other scenarios (e.g. stored with ScenarioStore).
+SCENARIO_STREAM_VERSION = 3  # 2 - Philox, 3 - no float32 scenario index
+SCENARIO_INDEX_KEY = "SCENARIO"  # position of a scenario in the stream
+
+
+def standard_normals(seed, start, stop, dimension, method="random"):
+    # Normals for the scenarios [start, stop) of the stream; the same
+    # scenario gets the same numbers however the stream is split.
+    if method not in SAMPLING_METHODS:
+        raise Exception(
+            f"Unknown sampling method {method}, use one of {SAMPLING_METHODS}"
+        )
+    if method == "sobol":
+        return sobol_normals(seed, start, stop, dimension)
+    first_chunk = start // CHUNK_SIZE
+    chunks = [np.zeros((0, dimension))]
+    for chunk in range(first_chunk, (stop + CHUNK_SIZE - 1) // CHUNK_SIZE):
+        # Philox is counter based: the chunk is the counter, so it is
+        # generated directly without the chunks before it (jump-ahead).
+        random = np.random.Generator(
+            np.random.Philox(key=seed, counter=[0, chunk, 0, 0])
+        )
+        if method == "antithetic":
+            # pairs x, -x in consecutive rows
+            half = random.standard_normal((CHUNK_SIZE // 2, dimension))
+            chunks.append(np.stack([half, -half], axis=1).reshape(-1, dimension))
+        else:
+            chunks.append(random.standard_normal((CHUNK_SIZE, dimension)))
+    offset = start - first_chunk * CHUNK_SIZE
+    return np.concatenate(chunks)[offset : offset + stop - start]
+
+
+@lru_cache(maxsize=4 * SOBOL_REPLICATES)
+def scrambled_sobol(seed, replicate, dimension):  # scrambling is expensive
+    return qmc.Sobol(
+        dimension, scramble=True, seed=np.random.default_rng([seed, replicate])
+    )
+
+
+def sobol_normals(seed, start, stop, dimension):
+    # Randomized QMC: scenario i is point i // SOBOL_REPLICATES of the
+    # independently scrambled sequence i % SOBOL_REPLICATES.
+    uniform = np.empty((stop - start, dimension))
+    for replicate in range(SOBOL_REPLICATES):
+        first = start + (replicate - start) % SOBOL_REPLICATES
+        if first >= stop:
+            continue
+        sampler = copy.deepcopy(scrambled_sobol(seed, replicate, dimension))
+        if first >= SOBOL_REPLICATES:
+            sampler.fast_forward(first // SOBOL_REPLICATES)
+        with warnings.catch_warnings():
+            # balance properties hold only for powers of 2, which is fine here
+            warnings.simplefilter("ignore", UserWarning)
+            uniform[first - start :: SOBOL_REPLICATES] = sampler.random(
+                len(range(first, stop, SOBOL_REPLICATES))
+            )
+    eps = np.finfo(float).eps
+    return norm.ppf(np.clip(uniform, eps, 1 - eps))
+
+
+@lru_cache(maxsize=4)  # shared by samplers with the same covariance
+def cholesky_factor(data, shape):
+    covariance = np.frombuffer(data).reshape(shape)
+    covariance = (covariance + covariance.T) / 2
+    try:
+        factor = np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        # Not positive definite (e.g. estimated from data) - repair it
+        # by dropping the negative eigenvalues.
+        values, vectors = np.linalg.eigh(covariance)
+        factor = vectors * np.sqrt(np.clip(values, 0.0, None))
+    factor.flags.writeable = False
+    return factor
+
+
+class CorrelatedNormalSampler:  # covariance is factorized only once
+    def __init__(self, mean, covariance):
+        self.mean = np.asarray(mean, dtype=float)
+        covariance = np.ascontiguousarray(covariance, dtype=float)
+        self.factor = cholesky_factor(covariance.tobytes(), covariance.shape)
+
+    def transform(self, normals):
+        return self.mean + normals @ self.factor.T
+
+
+def monte_carlo_scenario_range(
+    mean_scenario,
+    covariance,
+    keys=None,
+    start=0,
+    stop=1000,
+    seed=123,
+    method="random",
+    dtype=np.float64,
+    sampler=None,  # CorrelatedNormalSampler of the keys, to reuse it
+):
+    keys = scenario_keys(mean_scenario, keys)
+    if sampler is None:
+        sampler = CorrelatedNormalSampler([mean_scenario[k] for k in keys], covariance)
+    row = {**mean_scenario, SCENARIO_INDEX_KEY: 0}
+    index = {key: i for i, key in enumerate(row)}
+    block = np.empty((stop - start, len(row)))
+    block[:] = list(row.values())
+    block[:, index[SCENARIO_INDEX_KEY]] = np.arange(start, stop)
+    block[:, [index[key] for key in keys]] = sampler.transform(
+        standard_normals(seed, start, stop, len(keys), method)
+    )
+    # Generated in float64, the same scenarios in any dtype. The scenario
+    # index is the position in the stream, it is left out of other dtypes
+    # (see MonteCarloScenarios.scenario_block) to stay exact.
+    if np.dtype(dtype) == np.float64:
+        return block, index
+    scenarios = ScenarioBlock(block, index).astype(dtype)
+    return scenarios.block, scenarios.index
+
+
+def monte_carlo_scenario_block(
+    mean_scenario,
+    covariance,
+    keys=None,
+    n=1000,
+    seed=123,
+    method="random",
+    dtype=np.float64,
+):
+    return monte_carlo_scenario_range(
+        mean_scenario, covariance, keys, 0, n, seed, method, dtype
+    )
+
+
+def monte_carlo_scenario_blocks(
+    mean_scenario,
+    covariance,
+    keys=None,
+    seed=123,
+    block_size=CHUNK_SIZE,
+    method="random",
+    dtype=np.float64,
+):
+    keys = scenario_keys(mean_scenario, keys)
+    sampler = CorrelatedNormalSampler([mean_scenario[k] for k in keys], covariance)
+    start = 0
     while True:
-        i += 1
-        d = dict(mean_scenario)
-        d.update(
-            dict(
-                zip(
-                    keys, multivariate_normal.rvs(mean, covariance, random_state=random)
-                )
+        yield monte_carlo_scenario_range(
+            mean_scenario,
+            covariance,
+            keys,
+            start,
+            start + block_size,
+            seed,
+            method,
+            dtype,
+            sampler,
+        )
+        start += block_size
+
+
+def block_as_scenarios(block, index):  # Adapter
+    columns = list(index.keys())
+    for row in block.tolist():
+        yield dict(zip(columns, row))
+
+
+def block_columns(block, index):  # columnar scenario, no copies
+    return {key: block[:, i] for key, i in index.items()}
+
+
+def scenario_block(scenario_generator):  # Adapter - any generator to a block
+    if hasattr(scenario_generator, "block"):
+        return scenario_generator.block()
+    df = pd.DataFrame(list(scenario_generator()))
+    return df.to_numpy(dtype=float), {key: i for i, key in enumerate(df.columns)}
+
+
+class ScenarioBlock:  # Scenarios as rows of a 2-D array, accessed by columns
+    # Can be used wherever a scenario is accessed as scenario[key], without
+    # the per scenario overhead of dicts or pandas rows.
+    def __init__(self, block, index, scenario_index=None):
+        self.block = block
+        self.index = index  # key -> column
+        # int64 scenario indices kept outside of a float32 block, exact
+        # beyond the 2 ** 24 integers float32 can represent
+        self.scenario_index = scenario_index
+
+    @classmethod
+    def from_generator(cls, scenario_generator):
+        if hasattr(scenario_generator, "scenario_block"):
+            return scenario_generator.scenario_block()
+        return cls(*scenario_block(scenario_generator))
+
+    def __len__(self):
+        return len(self.block)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):  # rows, a view without copies
+            return ScenarioBlock(
+                self.block[key],
+                self.index,
+                None if self.scenario_index is None else self.scenario_index[key],
             )
+        if key == SCENARIO_INDEX_KEY and self.scenario_index is not None:
+            return self.scenario_index
+        return self.block[:, self.index[key]]
+
+    def __contains__(self, key):  # a dict lookup, no list of the keys
+        return key in self.index or (
+            key == SCENARIO_INDEX_KEY and self.scenario_index is not None
         )
-        # print(f"scenario {i} generated")
-        yield d
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        if self.scenario_index is None:
+            return list(self.index)
+        return [*self.index, SCENARIO_INDEX_KEY]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def column(self, i):
+        return self.block[:, i]
+
+    def columns(self):
+        return {key: self[key] for key in self.keys()}
+
+    def batches(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield self[start : start + batch_size]
+
+    def rows(self):
+        rows = block_as_scenarios(self.block, self.index)
+        if self.scenario_index is None:
+            return rows
+        return (
+            {**row, SCENARIO_INDEX_KEY: i}
+            for row, i in zip(rows, self.scenario_index.tolist())
+        )
+
+    @classmethod
+    def concatenate(cls, blocks):  # of blocks with the same columns
+        scenario_index = None
+        if blocks[0].scenario_index is not None:
+            scenario_index = np.concatenate([b.scenario_index for b in blocks])
+        return cls(
+            np.concatenate([b.block for b in blocks]), blocks[0].index, scenario_index
+        )
+
+    def astype(self, dtype):
+        if np.dtype(dtype) == np.float64 or SCENARIO_INDEX_KEY not in self.index:
+            block = self.block.astype(dtype, copy=False)
+            return ScenarioBlock(block, self.index, self.scenario_index)
+        # the scenario index column is not cast, it is kept as int64
+        keys = [key for key in self.index if key != SCENARIO_INDEX_KEY]
+        block = np.empty((len(self), len(keys)), dtype=dtype)
+        for i, key in enumerate(keys):
+            block[:, i] = self[key]
+        scenario_index = self[SCENARIO_INDEX_KEY].astype(np.int64)
+        return ScenarioBlock(block, dict(zip(keys, range(len(keys)))), scenario_index)
+
+
+def scenario_blocks(scenario_generator, block_size=CHUNK_SIZE):  # Adapter
+    # ScenarioBlocks of block_size rows from any generator, streamed
+    if hasattr(scenario_generator, "blocks"):
+        yield from scenario_generator.blocks(block_size)
+        return
+    scenarios = iter(scenario_generator())
+    while True:
+        df = pd.DataFrame(list(islice(scenarios, block_size)))
+        if not len(df):
+            break
+        yield dataframe_block(df)
+
+
+def block_sizes(block_size):
+    # blocks(block_size) takes a size or a function giving the size of the
+    # next block (e.g. AdaptiveBatcher.next_block_size)
+    return block_size if callable(block_size) else lambda: block_size
+
+
+def resized_blocks(blocks, block_size):  # the blocks rebatched to block_size
+    next_size = block_sizes(block_size)
+    pieces, count, size = [], 0, next_size()
+    for block in blocks:
+        while len(block):
+            piece = block[: size - count]
+            pieces.append(piece)
+            count += len(piece)
+            block = block[len(piece) :]
+            if count == size:
+                yield ScenarioBlock.concatenate(pieces)
+                pieces, count, size = [], 0, next_size()
+    if count:
+        yield ScenarioBlock.concatenate(pieces)
+
+
+def monte_carlo_scenarios(
+    mean_scenario,
+    covariance,
+    keys=None,
+    seed=123,
+    block_size=CHUNK_SIZE,
+    method="random",
+    dtype=np.float64,
+):
+    for block, index in monte_carlo_scenario_blocks(
+        mean_scenario, covariance, keys, seed, block_size, method
+    ):
+        yield from ScenarioBlock(block, index).astype(dtype).rows()
 
 
 def dataframe_as_scenarios(df):  # Adapter
-    for i, row in df.iterrows():
-        yield row
+    # plain dicts, much faster than the pandas rows of df.iterrows()
+    columns = list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        yield dict(zip(columns, row))
+
 
+def dataframe_block(df, columns=None):  # Adapter - numeric columns only
+    if columns is None:
+        columns = list(df.select_dtypes("number").columns)
+    return ScenarioBlock(
+        df[columns].to_numpy(dtype=float), {key: i for i, key in enumerate(columns)}
+    )
 
-def scenarios_from_file(filename):
+
+ARROW_FORMATS = {".parquet": "parquet", ".feather": "feather", ".arrow": "feather"}
+
+
+def arrow_format(filename):
+    for suffix, file_format in ARROW_FORMATS.items():
+        if filename.endswith(suffix):
+            if pyarrow is None:
+                raise Exception(f"Reading or writing {filename} needs pyarrow")
+            return file_format
+    return None
+
+
+def arrow_file_blocks(filename, block_size, columns=None, filter=None):
+    dataset = pyarrow.dataset.dataset(filename, format=arrow_format(filename))
+    names = [
+        field.name
+        for field in dataset.schema
+        if pyarrow.types.is_integer(field.type) or pyarrow.types.is_floating(field.type)
+    ]
+    if columns is not None:
+        names = [name for name in names if name in set(columns)]
+    index = {name: i for i, name in enumerate(names)}
+    # Only the projected columns are read, and row groups which can not
+    # match the filter (by their min/max statistics) are skipped.
+    for batch in dataset.to_batches(
+        columns=names, filter=filter, batch_size=block_size
+    ):
+        block = np.empty((batch.num_rows, len(names)))
+        for i, column in enumerate(batch.columns):
+            block[:, i] = column.to_numpy(zero_copy_only=False)
+        if len(block):
+            yield ScenarioBlock(block, index)
+
+
+def with_scenario_index(blocks):
+    # numbers the rows of blocks without a scenario index column
+    start = 0
+    for block in blocks:
+        if SCENARIO_INDEX_KEY not in block:
+            index = np.arange(start, start + len(block))
+            block = ScenarioBlock(
+                np.column_stack([block.block, index]),
+                {**block.index, SCENARIO_INDEX_KEY: block.block.shape[1]},
+            )
+        start += len(block)
+        yield block
+
+
+def scenario_file_blocks(
+    filename, block_size=10 * CHUNK_SIZE, columns=None, filter=None
+):
+    # ScenarioBlocks of block_size rows. CSV and Arrow files are read in
+    # chunks, so the memory does not depend on the size of the file.
+    # columns selects the scenario keys to read, filter (a pyarrow
+    # expression, e.g. pyarrow.dataset.field("DAY") <= 10) the rows of a
+    # Parquet or Feather file. Files without a scenario index column get
+    # the position of the row (among the rows read) as index.
+    blocks = file_blocks(filename, block_size, columns, filter)
+    if columns is None or SCENARIO_INDEX_KEY in columns:
+        blocks = with_scenario_index(blocks)
+    return blocks
+
+
+def file_blocks(filename, block_size, columns=None, filter=None):
+    if arrow_format(filename):
+        yield from arrow_file_blocks(filename, block_size, columns, filter)
+        return
+    if filter is not None:
+        raise Exception(f"Scenario filters need a Parquet or Feather file: {filename}")
+    usecols = None if columns is None else set(columns).__contains__
     if filename.endswith(".csv"):
-        df = pd.read_csv(filename)
+        selected = None  # numeric columns of the first chunk
+        for df in pd.read_csv(filename, chunksize=block_size, usecols=usecols):
+            block = dataframe_block(df, selected)
+            selected = list(block.keys())
+            yield block
+    elif filename.endswith(".xlsx"):  # no chunked reader for Excel
+        df = pd.read_excel(filename, usecols=usecols)
+        yield from dataframe_block(df).batches(block_size)
+    elif filename.endswith(".npy"):
+        from scenario_store import ScenarioStore
+
+        block, index = ScenarioStore(filename).open()
+        if columns is not None:  # projected by the index, no copies
+            index = {key: i for key, i in index.items() if key in set(columns)}
+        yield from ScenarioBlock(block, index).batches(block_size)
+    else:
+        raise Exception(f"Unknown scenario file format: {filename}")
+
+
+def file_frames(filename, block_size):  # DataFrames of every column
+    if arrow_format(filename):
+        dataset = pyarrow.dataset.dataset(filename, format=arrow_format(filename))
+        for batch in dataset.to_batches(batch_size=block_size):
+            yield batch.to_pandas()
+    elif filename.endswith(".csv"):
+        yield from pd.read_csv(filename, chunksize=block_size)
     elif filename.endswith(".xlsx"):
-        df = pd.read_excel(filename)
-    return dataframe_as_scenarios(df)
+        yield pd.read_excel(filename)
+    else:  # numeric only
+        for block in file_blocks(filename, block_size):
+            yield pd.DataFrame(block.columns())
+
+
+def scenarios_from_file(filename, block_size=10 * CHUNK_SIZE):
+    # Rows as dicts of every column, the non-numeric ones too (the blocks
+    # of scenario_file_blocks leave them out). Read in chunks, and like the
+    # blocks, files without a scenario index column get the row number.
+    start = 0
+    for df in file_frames(filename, block_size):
+        if SCENARIO_INDEX_KEY not in df:
+            df = df.assign(**{SCENARIO_INDEX_KEY: np.arange(start, start + len(df))})
+        start += len(df)
+        yield from dataframe_as_scenarios(df)
+
+
+def write_scenario_file(filename, scenario_generator, block_size=10 * CHUNK_SIZE):
+    # Parquet (a row group of block_size scenarios, with statistics for the
+    # filters) or Feather file. The scenario generator must be finite.
+    file_format = arrow_format(filename)
+    if file_format is None:
+        raise Exception(f"Scenarios can be written to Parquet or Feather: {filename}")
+    writer = None
+    for block in scenario_blocks(scenario_generator, block_size):
+        table = pyarrow.table({key: block[key] for key in block.keys()})
+        if writer is None and file_format == "parquet":
+            writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+        elif writer is None:
+            writer = pyarrow.ipc.new_file(filename, table.schema)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+
+class ScenarioFile:  # Scenario generator reading a file block by block
+    def __init__(
+        self,
+        filename,
+        count=None,
+        block_size=10 * CHUNK_SIZE,
+        columns=None,
+        filter=None,
+    ):
+        self.filename = filename
+        self.count = count  # at most count scenarios if given
+        self.block_size = block_size
+        self.columns = columns  # e.g. required_scenario_keys of a portfolio
+        self.filter = filter  # pyarrow expression for Parquet and Feather
+
+    def with_columns(self, columns):
+        self.columns = columns
+        return self
+
+    def with_filter(self, filter):
+        self.filter = filter
+        return self
+
+    def blocks(self, block_size=None):
+        if callable(block_size):  # sizes chosen while reading
+            yield from resized_blocks(self.blocks(), block_size)
+            return
+        remaining = self.count
+        for block in scenario_file_blocks(
+            self.filename, block_size or self.block_size, self.columns, self.filter
+        ):
+            if remaining is not None:
+                block = block[:remaining]
+                remaining -= len(block)
+            if len(block):
+                yield block
+            if remaining == 0:
+                break
+
+    def block(self):
+        blocks = list(self.blocks())
+        if not blocks:
+            return np.zeros((0, 0)), {}
+        scenarios = ScenarioBlock.concatenate(blocks)
+        return scenarios.block, scenarios.index
+
+    def __call__(self):
+        for block in self.blocks():
+            yield from block.rows()
+
+
+DEFAULT_MEAN_SCENARIO = {
+    "DAY": 1,
+    "CPH:NDA-DK": 67.63,
+    "CPH:DANSKE": 106.1,
+    "CPH:NDA-DK-volatility": 1,
+    "EONIA": -0.0049,
+    "DKKLIBOR-1W": -0.00002,
+}
+DEFAULT_COVARIANCE = [[2.0, 0.5], [0.5, 1.0]]
+DEFAULT_RANDOM_KEYS = ["CPH:NDA-DK", "CPH:DANSKE"]
+
+
+def scenario_fingerprint(
+    mean_scenario, covariance, keys, seed, count, method, dtype=np.float64
+):
+    h = hashlib.sha256()
+    h.update(repr(list(mean_scenario.items())).encode())
+    covariance = np.asarray(covariance, dtype=float)
+    h.update(repr(covariance.shape).encode())
+    h.update(covariance.tobytes())
+    h.update(repr((list(keys), seed, count, method, np.dtype(dtype).str)).encode())
+    return h.hexdigest()
+
+
+class ScenarioCache:  # LRU cache of scenario blocks, limited by size in bytes
+    def __init__(self, max_bytes=1_000_000_000):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint, create):
+        if fingerprint in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(fingerprint)
+            return self.blocks[fingerprint]
+        self.misses += 1
+        block, index = create()
+        block.flags.writeable = False  # shared by all users of the cache
+        if block.nbytes <= self.max_bytes:
+            self.blocks[fingerprint] = (block, index)
+            self.bytes += block.nbytes
+            while self.bytes > self.max_bytes:
+                old_block, old_index = self.blocks.popitem(last=False)[1]
+                self.bytes -= old_block.nbytes
+        return block, index
+
+    def clear(self):
+        self.blocks.clear()
+        self.bytes = 0
+
+
+SCENARIO_CACHE = ScenarioCache()
+
+
+class MonteCarloScenarios:  # Scenario generator which can be pickled and sharded
+    def __init__(
+        self,
+        mean_scenario,
+        covariance,
+        keys=None,
+        seed=123,
+        count=None,
+        method="random",  # "random", "antithetic" or scrambled "sobol"
+        dtype=np.float64,  # e.g. np.float32 for half the memory
+    ):
+        self.mean_scenario = mean_scenario
+        self.covariance = covariance
+        self.keys = scenario_keys(mean_scenario, keys)
+        self.seed = seed
+        self.count = count
+        self.method = method
+        self.dtype = dtype
+        self.sampler = None  # built on the first range
+
+    def __getstate__(self):  # the sampler is rebuilt, not pickled
+        state = dict(self.__dict__)
+        state["sampler"] = None
+        return state
+
+    def normal_sampler(self):
+        if self.sampler is None:
+            self.sampler = CorrelatedNormalSampler(
+                [self.mean_scenario[k] for k in self.keys], self.covariance
+            )
+        return self.sampler
+
+    def fingerprint(self):
+        return scenario_fingerprint(
+            self.mean_scenario,
+            self.covariance,
+            self.keys,
+            self.seed,
+            self.count,
+            self.method,
+            self.dtype,
+        )
+
+    def block(self):
+        # Identical generators (e.g. in cloned simulations) share one block
+        return SCENARIO_CACHE.get(
+            self.fingerprint(),
+            lambda: monte_carlo_scenario_block(
+                self.mean_scenario,
+                self.covariance,
+                self.keys,
+                self.count,
+                self.seed,
+                self.method,
+                self.dtype,
+            ),
+        )
+
+    def __call__(self):
+        for block in self.blocks():
+            yield from block.rows()
+
+    def scenario_block(self, start=0, stop=None):
+        # ScenarioBlock of the scenarios [start, stop), all by default,
+        # with the exact scenario index
+        if stop is None:
+            block, index = self.block()
+        else:
+            block, index = self.shard(None, start, stop)
+        if SCENARIO_INDEX_KEY in index:
+            return ScenarioBlock(block, index)
+        return ScenarioBlock(block, index, np.arange(start, start + len(block)))
+
+    def blocks(self, block_size=CHUNK_SIZE):
+        # Generated range by range and not cached, the memory does not
+        # depend on the number of scenarios.
+        next_size = block_sizes(block_size)
+        start = 0
+        while self.count is None or start < self.count:
+            stop = start + next_size()
+            if self.count is not None:
+                stop = min(stop, self.count)
+            yield self.scenario_block(start, stop)
+            start = stop
+
+    def standard_error_estimator(self, start=0):
+        # for the prices of the scenarios from start on, in order
+        if self.method == "antithetic":
+            return AntitheticStandardError()
+        if self.method == "sobol":
+            return ReplicateStandardError(SOBOL_REPLICATES, start)
+        return None  # independent samples
+
+    def shard(self, shard, start, stop):
+        # Random access into the stream, so the result does not depend
+        # on how the scenarios are sharded.
+        return monte_carlo_scenario_range(
+            self.mean_scenario,
+            self.covariance,
+            self.keys,
+            start,
+            stop,
+            self.seed,
+            self.method,
+            self.dtype,
+            self.normal_sampler(),
+        )
+
+
+def default_monte_carlo_scenarios():
+    return MonteCarloScenarios(
+        DEFAULT_MEAN_SCENARIO,
+        DEFAULT_COVARIANCE,
+        DEFAULT_RANDOM_KEYS,
+        count=config()["max_number_of_scenarios"],
+    )
+
+
+def default_scenario_generator():  # like default_scenarios, with blocks
+    if config()["scenarios"] == "MonteCarlo":
+        return default_monte_carlo_scenarios()
+    return ScenarioFile(
+        config()["scenarios"], count=config()["max_number_of_scenarios"] or None
+    )
 
 
 def default_scenarios():
     if config()["scenarios"] == "MonteCarlo":
-        scenario = {
-            "DAY": 1,
-            "CPH:NDA-DK": 67.63,
-            "CPH:DANSKE": 106.1,
-            "CPH:NDA-DK-volatility": 1,
-            "EONIA": -0.0049,
-            "DKKLIBOR-1W": -0.00002,
-        }
-        scenarios = monte_carlo_scenarios(
-            scenario, [[2.0, 0.5], [0.5, 1.0]], ["CPH:NDA-DK", "CPH:DANSKE"]
-        )
+        scenarios = default_monte_carlo_scenarios()()
     else:
         scenarios = scenarios_from_file(config()["scenarios"])
     if config()["max_number_of_scenarios"]:
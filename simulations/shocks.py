@@ -1,3 +1,7 @@
+import functools
+import sys
+
+
 class ShockMixin:  # Mixin, can be further extended
     def __add__(self, shock):
         return CombinedShock(self, shock)
@@ -12,10 +16,19 @@ class ShockMixin:  # Mixin, can be further extended
 class ShockProxy(ShockMixin):  # Proxy
     def __init__(self, shock):
         self.shock = shock
+        functools.update_wrapper(self, shock)
 
     def __call__(self, scenario):
         return self.shock(scenario)
 
+    def __reduce__(self):
+        # Picklable for worker processes. The name of a decorated module
+        # level function refers to this proxy, so it is pickled by name.
+        module = sys.modules.get(self.__module__)
+        if getattr(module, self.__qualname__, None) is self:
+            return self.__qualname__
+        return ShockProxy, (self.shock,)
+
 
 def rich_shock(f):
     return ShockProxy(f)
@@ -68,30 +81,31 @@ class ScenarioShock(ShockMixin):  # Adapter
         return scenario
 
 
-def absolute_shock(risk_factor, value):
-    @rich_shock
-    def do_shock(
-        scenario, risk_factor=risk_factor, value=value
-    ):  # Be careful about passing parameters
+class AbsoluteShock(ShockMixin):  # a class, so that it can be pickled
+    def __init__(self, risk_factor, value):
+        self.risk_factor = risk_factor
+        self.value = value
+
+    def __call__(self, scenario):
         scenario = {**scenario}
-        scenario[risk_factor] = value
+        scenario[self.risk_factor] = self.value
         return scenario
 
-    return do_shock
-
-    # alternatively use lambda function
-    return lambda shock, risk_factor=risk_factor, value=value: absolute_shock1(
-        scenario, risk_factor, value
-    )
 
+class RelativeShock(ShockMixin):
+    def __init__(self, risk_factor, value):
+        self.risk_factor = risk_factor
+        self.value = value
 
-def relative_shock(risk_factor, value):
-    @rich_shock
-    def do_shock(
-        scenario, risk_factor=risk_factor, value=value
-    ):  # Be careful about passing parameters
+    def __call__(self, scenario):
         scenario = {**scenario}
-        scenario[risk_factor] = scenario[risk_factor] * value
+        scenario[self.risk_factor] = scenario[self.risk_factor] * self.value
         return scenario
 
-    return do_shock
+
+def absolute_shock(risk_factor, value):
+    return AbsoluteShock(risk_factor, value)
+
+
+def relative_shock(risk_factor, value):
+    return RelativeShock(risk_factor, value)
@@ -3,18 +3,39 @@ from portfolio import *
 from scenarios import *
 from pricing import *
 from shocks import no_shock
+from accumulators import PriceStatistics
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from itertools import repeat
+from time import time
 import pandas as pd
+import copy
+
+
+def standard_error_estimator(scenario_generator, start=0):
+    # None (independent samples) unless the generator knows better
+    if hasattr(scenario_generator, "standard_error_estimator"):
+        return scenario_generator.standard_error_estimator(start)
+    return None
 
 
 class Simulation:
+    confidence_level = 0.99
+    quantile_compression = 200  # higher is more accurate
+    approximation_sample_size = 1000
+    dtype = np.float64  # scenarios and intermediates, statistics are float64
+    results = ("prices", "statistics")
+
     def __init__(
         self, portfolio=None, scenario_generator=None, pricing_engine=None, shock=None
     ):
         self.portfolio = portfolio or default_portfolio()
-        self.scenario_generator = scenario_generator or default_scenarios
+        self.scenario_generator = scenario_generator or default_scenario_generator()
         self.pricing_engine = pricing_engine or default_pricing_engine()
         self.shock = shock or no_shock
+        self.streaming = False
         self.prices = None
+        self.statistics = None
         # print("Simulation initialized")
 
     @classmethod
@@ -51,11 +72,95 @@ class Simulation:
         self.shock = shock
         return self
 
+    def with_streaming(self, streaming=True):
+        # Streaming statistics do not keep the price vector in memory
+        self.streaming = streaming
+        return self
+
+    def with_risk_measures(self, confidence_level=0.99, quantile_compression=200):
+        self.confidence_level = confidence_level
+        self.quantile_compression = quantile_compression
+        return self
+
+    def with_dtype(self, dtype):
+        # np.float32 halves the memory of the vectorized simulations,
+        # the report then compares the results with a float64 run.
+        self.dtype = dtype
+        return self
+
+    def reset(self):  # forgets the results, e.g. after changing settings
+        for name in self.results:
+            setattr(self, name, None)
+        return self
+
+    def with_projected_scenarios(self):
+        # a scenario file (ScenarioFile) reads only the columns the
+        # portfolio depends on, generated scenarios are left as they are
+        if hasattr(self.scenario_generator, "with_columns"):
+            keys = required_scenario_keys(self.portfolio, self.pricing_engine)
+            self.scenario_generator = self.scenario_generator.with_columns(keys)
+        return self
+
+    def with_approximation(self, order=2, sample_size=1000, base_scenario=None):
+        # Delta-gamma(-vega) revaluation instead of full pricing, the base
+        # scenario defaults to the mean of the first sample_size scenarios.
+        if base_scenario is None:
+            scenarios = islice(self.scenario_generator(), sample_size)
+            base_scenario = pd.DataFrame(list(scenarios)).mean().to_dict()
+            if SCENARIO_INDEX_KEY in base_scenario:
+                base_scenario[SCENARIO_INDEX_KEY] = np.nan  # no residual
+        self.portfolio = TaylorApproximation(
+            compile_portfolio(self.portfolio), base_scenario, order
+        )
+        self.approximation_sample_size = sample_size
+        return self
+
+    def approximation_error(self):
+        # full revaluation of a sample of (shocked) scenarios
+        scenarios = islice(self.scenario_generator(), self.approximation_sample_size)
+        scenarios = pd.DataFrame([self.shock(s) for s in scenarios])
+        exact = self.portfolio.plan.price(scenarios, self.pricing_engine)
+        approximate = self.portfolio.price(scenarios, self.pricing_engine)
+        error = approximate - exact
+        return dict(
+            sample_size=len(error),
+            mean_error=np.mean(error),
+            max_abs_error=np.max(np.abs(error)),
+            rms_error=np.sqrt(np.mean(error ** 2)),
+            relative_rms_error=np.sqrt(np.mean(error ** 2)) / np.std(exact),
+        )
+
+    def dtype_error(self):
+        # Differences of the risk measures to the same simulation in float64.
+        # A float32 scenario generator is compared with float64 pricing of
+        # its (rounded) scenarios.
+        reference = copy.copy(self).with_dtype(np.float64).reset().get_statistics()
+        statistics = self.get_statistics()
+        level = self.confidence_level
+
+        def measures(s):
+            return dict(
+                mean=s.mean,
+                std=s.std,
+                value_at_risk=s.value_at_risk(level),
+                expected_shortfall=s.expected_shortfall(level),
+            )
+
+        reference = measures(reference)
+        return {
+            key: value - reference[key] for key, value in measures(statistics).items()
+        }
+
     def clone(self):
-        return Simulation(
-            portfolio=self.portfolio,
-            scenario_generator=self.scenario_generator,
-            pricing_engine=self.pricing_engine,
+        return (
+            Simulation(
+                portfolio=self.portfolio,
+                scenario_generator=self.scenario_generator,
+                pricing_engine=self.pricing_engine,
+            )
+            .with_streaming(self.streaming)
+            .with_risk_measures(self.confidence_level, self.quantile_compression)
+            .with_dtype(self.dtype)
         )
 
     def get_prices(self):  # Mediator
@@ -67,35 +172,100 @@ class Simulation:
             ]
         return self.prices
 
+    def price_batches(self, batch_size=1000):
+        prices = (
+            self.portfolio.price(self.shock(s), self.pricing_engine)
+            for s in self.scenario_generator()
+        )
+        while True:
+            batch = np.fromiter(islice(prices, batch_size), dtype=float)
+            if not len(batch):
+                break
+            yield batch
+
+    def new_statistics(self):
+        return PriceStatistics(
+            self.quantile_compression, standard_error_estimator(self.scenario_generator)
+        )
+
+    def get_statistics(self):
+        if self.statistics is None:
+            if self.streaming and self.prices is None:
+                self.statistics = self.new_statistics()
+                for prices in self.price_batches():
+                    self.statistics.update(prices)
+            else:
+                self.statistics = self.new_statistics().update(self.get_prices())
+        return self.statistics
+
     @property
     def mean_price(self):
-        prices = self.get_prices()
-        return np.mean(prices)
+        return self.get_statistics().mean
 
     @property
     def price_volatility(self):
-        prices = self.get_prices()
-        return np.std(prices)
+        return self.get_statistics().std
 
     def report(self, output=None):  # Facade
-        prices = self.get_prices()
-        print("Mean price:         ", np.mean(prices), file=output)
-        print("Minimum price:      ", np.min(prices), file=output)
-        print("Maximum price:      ", np.max(prices), file=output)
-        print("Standard deviation: ", np.std(prices), file=output)
+        statistics = self.get_statistics()
+        print("Scenarios:          ", statistics.count, file=output)
+        print("Mean price:         ", statistics.mean, file=output)
+        print("Minimum price:      ", statistics.minimum, file=output)
+        print("Maximum price:      ", statistics.maximum, file=output)
+        print("Standard deviation: ", statistics.std, file=output)
+        print("Standard error:     ", statistics.standard_error, file=output)
+        level = self.confidence_level
+        print(
+            f"Quantile {1-level:.1%}:".ljust(20),
+            statistics.quantile(1 - level),
+            file=output,
+        )
+        print(
+            f"VaR {level:.1%}:".ljust(20),
+            statistics.value_at_risk(level),
+            file=output,
+        )
+        print(
+            f"ES {level:.1%}:".ljust(20),
+            statistics.expected_shortfall(level),
+            file=output,
+        )
+        if isinstance(self.portfolio, TaylorApproximation):
+            error = self.approximation_error()
+            print(
+                f"Approximation error, {error['sample_size']} scenarios:", file=output
+            )
+            print("  Mean error:       ", error["mean_error"], file=output)
+            print("  Max abs error:    ", error["max_abs_error"], file=output)
+            print("  RMS error:        ", error["rms_error"], file=output)
+            print("  RMS error / std:  ", error["relative_rms_error"], file=output)
+        if np.dtype(self.dtype) != np.float64:
+            error = self.dtype_error()
+            print(f"{np.dtype(self.dtype).name} error vs float64:", file=output)
+            print("  Mean price:       ", error["mean"], file=output)
+            print("  Std:              ", error["std"], file=output)
+            print(f"  VaR {level:.1%}:".ljust(20), error["value_at_risk"], file=output)
+            print(
+                f"  ES {level:.1%}:".ljust(20), error["expected_shortfall"], file=output
+            )
 
 
 class VectorizedSimulation(Simulation):
-    def shocked_scenarios_df(self):
-        return pd.DataFrame([self.shock(s) for s in self.scenario_generator()])
-
     def get_prices(self):
         if self.prices is None:
             # print("Calculating prices (vectorized)")
-            scenarios_df = self.shocked_scenarios_df()
-            self.prices = self.portfolio.price(scenarios_df, self.pricing_engine)
+            # all scenarios as one block, the shock is applied to the columns
+            scenarios = ScenarioBlock.from_generator(self.scenario_generator)
+            scenarios = scenarios.astype(self.dtype)
+            self.prices = np.broadcast_to(
+                self.portfolio.price(self.shock(scenarios), self.pricing_engine),
+                (len(scenarios),),
+            )
         return self.prices
 
+    def price_batches(self):
+        yield np.asarray(self.get_prices(), dtype=float)
+
 
 def batch(it, batch_size=1000):
     buffer = []
@@ -108,19 +278,390 @@ def batch(it, batch_size=1000):
         yield pd.DataFrame(buffer)
 
 
+class AdaptiveBatcher:  # Strategy - replaces batch with a self-tuning batch size
+    def __init__(
+        self,
+        memory_budget=500_000_000,
+        target_time=0.5,
+        initial_size=1000,
+        min_size=100,
+        memory_factor=20,
+    ):
+        self.memory_budget = memory_budget  # bytes
+        self.target_time = target_time  # seconds per batch
+        self.initial_size = initial_size
+        self.min_size = min_size
+        # Pricing needs several temporaries per scenario row,
+        # the batch itself is only a fraction of the memory used.
+        self.memory_factor = memory_factor
+        self.sizes = []
+        # block sizing (blocks, next_block_size)
+        self.size = initial_size
+        self.last_block = None  # priced since the last size request
+        self.start = None  # time of the last size request
+
+    def adapt(self, size, bytes_per_scenario, elapsed):
+        size = size * np.clip(self.target_time / max(elapsed, 1e-6), 0.5, 2.0)
+        size = min(size, self.memory_budget / (bytes_per_scenario * self.memory_factor))
+        return max(int(size), self.min_size)
+
+    def next_size(self, df, elapsed):
+        return self.adapt(len(df), df.memory_usage().sum() / len(df), elapsed)
+
+    def __call__(self, it):
+        it = iter(it)
+        size = self.initial_size
+        self.sizes = []
+        while True:
+            start = time()
+            buffer = list(islice(it, size))
+            if not buffer:
+                break
+            df = pd.DataFrame(buffer)
+            yield df
+            # Time between the start and resuming the generator covers
+            # building and pricing the batch.
+            self.sizes.append(len(df))
+            if len(df) == size:
+                size = self.next_size(df, time() - start)
+
+    def next_block_size(self):
+        # Asked by the scenario generator before each block, the time since
+        # the last request covers generating and pricing the last block.
+        block = self.last_block
+        if block is not None and len(block) == self.size:
+            self.size = self.adapt(
+                self.size, block.block.nbytes / len(block), time() - self.start
+            )
+        self.last_block = None
+        self.start = time()
+        return self.size
+
+    def blocks(self, scenario_generator):  # columnar blocks, sized as above
+        self.sizes = []
+        self.size = self.initial_size
+        self.last_block = None
+        for block in scenario_generator.blocks(self.next_block_size):
+            self.last_block = block
+            self.sizes.append(len(block))
+            yield block
+
+
 class BatchSimulation(Simulation):
+    batcher = staticmethod(batch)
+    batch_size = 10 * CHUNK_SIZE  # of the columnar blocks
+    target_standard_error = None
+    relative_standard_error = False
+
+    def with_batcher(self, batcher):
+        self.batcher = batcher
+        return self
+
+    def with_adaptive_batches(self, memory_budget=500_000_000, target_time=0.5):
+        return self.with_batcher(AdaptiveBatcher(memory_budget, target_time))
+
+    def with_target_standard_error(self, target, relative=False):
+        # Stops drawing batches once the standard error of the mean price
+        # (relative to the mean price if relative and the mean is not zero)
+        # is below the target.
+        # The scenario generator (max_number_of_scenarios) is the cap.
+        self.target_standard_error = target
+        self.relative_standard_error = relative
+        return self
+
+    def converged(self, statistics):
+        if self.target_standard_error is None or statistics.count < 2:
+            return False
+        # of the estimator, e.g. of antithetic pairs or Sobol replicates
+        standard_error = statistics.standard_error
+        if self.relative_standard_error and statistics.mean != 0:
+            standard_error /= abs(statistics.mean)  # a zero mean: absolute
+        return standard_error <= self.target_standard_error
+
+    def columnar_blocks(self):  # None if the batches are built from rows
+        if not hasattr(self.scenario_generator, "blocks"):
+            return None
+        if self.batcher is batch:
+            return self.scenario_generator.blocks(self.batch_size)
+        if isinstance(self.batcher, AdaptiveBatcher):
+            return self.batcher.blocks(self.scenario_generator)
+        return None
+
     def shocked_scenario_batches(self):
-        for x in batch(self.shock(s) for s in self.scenario_generator()):
-            yield x
+        blocks = self.columnar_blocks()
+        if blocks is not None:
+            # columnar blocks (Monte Carlo, scenario files), the shock is
+            # applied to the columns
+            for scenarios in blocks:
+                yield self.shock(scenarios.astype(self.dtype)), len(scenarios)
+            return
+        for scenarios_df in self.batcher(
+            self.shock(s) for s in self.scenario_generator()
+        ):
+            # the scenario index is not cast, it stays exact, and
+            # non-numeric columns (e.g. a date in a scenario file) are kept
+            numeric = scenarios_df.select_dtypes("number").columns
+            dtypes = dict.fromkeys(numeric, self.dtype)
+            dtypes.pop(SCENARIO_INDEX_KEY, None)
+            yield scenarios_df.astype(dtypes, copy=False), len(scenarios_df)
+
+    def price_batches(self):
+        statistics = PriceStatistics(
+            estimator=standard_error_estimator(self.scenario_generator)
+        )
+        for i, (scenarios, count) in enumerate(self.shocked_scenario_batches()):
+            # print(f"Calculating prices (batch {i+1})")
+            prices = np.broadcast_to(
+                np.asarray(
+                    self.portfolio.price(scenarios, self.pricing_engine), dtype=float
+                ),
+                (count,),
+            )
+            yield prices
+            if self.converged(statistics.update(prices)):
+                break
 
     def get_prices(self):
         if self.prices is None:
             self.prices = []
-            for i, scenarios_df in enumerate(self.shocked_scenario_batches()):
-                # print(f"Calculating prices (batch {i+1})")
-                self.prices.extend(
-                    self.portfolio.price(scenarios_df, self.pricing_engine)
+            for prices in self.price_batches():
+                self.prices.extend(prices)
+        return self.prices
+
+
+def changed_keys(scenario, shocked_scenario):
+    # Shocks copy the scenario dict and keep the untouched columns as they are,
+    # so a column which is not the same object has been modified.
+    keys = set(scenario.keys()) | set(shocked_scenario.keys())
+    return [k for k in keys if scenario.get(k) is not shocked_scenario.get(k)]
+
+
+class ShockImpactSimulation(Simulation):
+    # Prices the base and the shocked scenarios in one pass. Every position
+    # is priced once on the base block, the ones depending on a shocked risk
+    # factor again on the shocked block, which gives the P&L.
+    batch_size = 10000
+    results = Simulation.results + ("base_prices", "pnl", "pnl_statistics")
+
+    def __init__(
+        self, portfolio=None, scenario_generator=None, pricing_engine=None, shock=None
+    ):
+        super().__init__(portfolio, scenario_generator, pricing_engine, shock)
+        self.base_prices = None
+        self.pnl = None
+        self.pnl_statistics = None
+
+    def clone(self):
+        return (
+            ShockImpactSimulation(
+                portfolio=self.portfolio,
+                scenario_generator=self.scenario_generator,
+                pricing_engine=self.pricing_engine,
+            )
+            .with_streaming(self.streaming)
+            .with_risk_measures(self.confidence_level, self.quantile_compression)
+            .with_dtype(self.dtype)
+        )
+
+    def pnl_batches(self):
+        plan = compile_portfolio(self.portfolio)
+        index = RiskFactorIndex(plan, self.pricing_engine)
+        # base and shocked scenarios are streamed block by block
+        for block in scenario_blocks(self.scenario_generator, self.batch_size):
+            scenarios = block.astype(self.dtype).columns()
+            shocked = self.shock(dict(scenarios))
+            # every position is priced once on the base block, only the
+            # affected ones again on the shocked block
+            base_positions = plan.position_prices(scenarios, self.pricing_engine)
+            base_prices = np.broadcast_to(
+                np.sum(base_positions, axis=-1, dtype=float), (len(block),)
+            )
+            positions = np.unique(index.affected(changed_keys(scenarios, shocked)))
+            pnl = np.zeros_like(base_prices)
+            if len(positions):
+                pnl = np.sum(
+                    plan.position_prices(shocked, self.pricing_engine, positions)
+                    - base_positions[..., positions],
+                    axis=-1,
+                    dtype=float,
                 )
+            yield base_prices, pnl
+
+    def calculate(self):
+        base_prices, pnl = [], []
+        for base_batch, pnl_batch in self.pnl_batches():
+            base_prices.append(base_batch)
+            pnl.append(pnl_batch)
+        self.base_prices = np.concatenate(base_prices) if base_prices else np.zeros(0)
+        self.pnl = np.concatenate(pnl) if pnl else np.zeros(0)
+        self.prices = self.base_prices + self.pnl
+
+    def get_prices(self):  # shocked prices
+        if self.prices is None:
+            self.calculate()
+        return self.prices
+
+    def get_pnl(self):
+        if self.pnl is None:
+            self.calculate()
+        return self.pnl
+
+    def price_batches(self):
+        for base_prices, pnl in self.pnl_batches():
+            yield base_prices + pnl
+
+    def get_statistics(self):
+        if self.statistics is None and self.streaming and self.pnl is None:
+            # prices and P&L accumulated in the same pass
+            self.statistics = self.new_statistics()
+            self.pnl_statistics = PriceStatistics()
+            for base_prices, pnl in self.pnl_batches():
+                self.statistics.update(base_prices + pnl)
+                self.pnl_statistics.update(pnl)
+        return super().get_statistics()
+
+    def get_pnl_statistics(self):
+        self.get_statistics()
+        if self.pnl_statistics is None:
+            self.pnl_statistics = PriceStatistics().update(self.get_pnl())
+        return self.pnl_statistics
+
+    def report(self, output=None):
+        super().report(output)
+        pnl = self.get_pnl_statistics()
+        print("Mean P&L:           ", pnl.mean, file=output)
+        print("Minimum P&L:        ", pnl.minimum, file=output)
+        print("Maximum P&L:        ", pnl.maximum, file=output)
+
+
+_WORKER = None
+
+
+def init_worker(portfolio, scenario_generator, pricing_engine, shock, dtype):
+    global _WORKER
+    try:
+        portfolio = compile_portfolio(portfolio)
+    except NotImplementedError:
+        pass  # price through the asset tree
+    _WORKER = (portfolio, scenario_generator, pricing_engine, shock, dtype)
+
+
+def price_shard(shard):  # runs in a worker process
+    portfolio, scenario_generator, pricing_engine, shock, dtype = _WORKER
+    i, start, stop = shard
+    scenarios = scenario_generator.scenario_block(start, stop)
+    prices = portfolio.price(shock(scenarios.astype(dtype)), pricing_engine)
+    return np.broadcast_to(np.asarray(prices, dtype=float), (len(scenarios),))
+
+
+def accumulate_shard(shard, compression):  # runs in a worker process
+    estimator = standard_error_estimator(_WORKER[1], start=shard[1])
+    return PriceStatistics(compression, estimator).update(price_shard(shard))
+
+
+class ParallelBatchSimulation(Simulation):
+    # Portfolio, scenario generator, pricing engine and shock are sent to the
+    # worker processes. The pool forks where it can (Linux, macOS), so they
+    # need to be picklable only with spawn (Windows, or with_start_method)
+    # or forkserver (after numba has started tbb, see fork_safe).
+    start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+
+    def __init__(
+        self,
+        portfolio=None,
+        scenario_generator=None,
+        pricing_engine=None,
+        shock=None,
+        workers=None,
+        batch_size=10 * CHUNK_SIZE,
+    ):
+        super().__init__(
+            portfolio=portfolio,
+            scenario_generator=scenario_generator,
+            pricing_engine=pricing_engine,
+            shock=shock,
+        )
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def with_workers(self, workers):
+        self.workers = workers
+        return self
+
+    def with_batch_size(self, batch_size):
+        self.batch_size = batch_size
+        return self
+
+    def with_start_method(self, start_method):  # "fork", "spawn" or None
+        self.start_method = start_method
+        return self
+
+    def clone(self):
+        return (
+            ParallelBatchSimulation(
+                portfolio=self.portfolio,
+                scenario_generator=self.scenario_generator,
+                pricing_engine=self.pricing_engine,
+                workers=self.workers,
+                batch_size=self.batch_size,
+            )
+            .with_start_method(self.start_method)
+            .with_streaming(self.streaming)
+            .with_risk_measures(self.confidence_level, self.quantile_compression)
+            .with_dtype(self.dtype)
+        )
+
+    def shards(self):
+        if not hasattr(self.scenario_generator, "scenario_block"):
+            raise Exception(
+                "ParallelBatchSimulation needs a scenario generator with shards, "
+                "e.g. MonteCarloScenarios"
+            )
+        count = self.scenario_generator.count or config()["max_number_of_scenarios"]
+        return [
+            (i, start, min(start + self.batch_size, count))
+            for i, start in enumerate(range(0, count, self.batch_size))
+        ]
+
+    def map_shards(self, function, *args):
+        shards = self.shards()
+        if hasattr(self.scenario_generator, "prepare"):
+            self.scenario_generator.prepare()  # once, before the workers start
+        start_method = self.start_method
+        if start_method == "fork" and not fork_safe():
+            start_method = "forkserver"  # forks from a process without tbb
+        with ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=init_worker,
+            initargs=(
+                self.portfolio,
+                self.scenario_generator,
+                self.pricing_engine,
+                self.shock,
+                self.dtype,
+            ),
+        ) as executor:
+            # map returns the results in scenario order
+            yield from executor.map(function, shards, *args)
+
+    def price_batches(self):
+        return self.map_shards(price_shard)
+
+    def get_statistics(self):
+        if self.statistics is None and self.streaming and self.prices is None:
+            # statistics are accumulated in the workers and merged here
+            self.statistics = self.new_statistics()
+            for statistics in self.map_shards(
+                accumulate_shard, repeat(self.quantile_compression)
+            ):
+                self.statistics.merge(statistics)
+        return super().get_statistics()
+
+    def get_prices(self):
+        if self.prices is None:
+            batches = list(self.price_batches())
+            self.prices = np.concatenate(batches) if batches else np.array([])
         return self.prices
 
 
@@ -0,0 +1,554 @@
+import pickle
+import numpy as np
+import pytest
+import config
+
+config._CONFIG = config.create_config()  # no config.yaml is read or written
+CONFIG = config._CONFIG
+
+from portfolio import *
+from pricing import *
+from scenarios import *
+from shocks import absolute_shock, danske_100, relative_shock
+from simulation import *
+
+
+def portfolio():
+    return (
+        Portfolio()
+        .equity_position(100.0, NORDEA_TICK)
+        .equity_position(10.0, DANSKE_TICK)
+        .with_asset(NORDEA.call_option(strike=70.0, maturity=10.0))
+        .with_asset(Position(3.0, VanillaCallOptionDK(100.0, 20.0, DANSKE.clone())))
+    )
+
+
+def scenarios(count=100, **kwargs):
+    return MonteCarloScenarios(
+        DEFAULT_MEAN_SCENARIO,
+        DEFAULT_COVARIANCE,
+        DEFAULT_RANDOM_KEYS,
+        count=count,
+        **kwargs,
+    )
+
+
+def object_model_prices(scenario_rows, pricing_engine, shock=no_shock):
+    return np.array(
+        [portfolio().price(shock(s), pricing_engine) for s in scenario_rows]
+    )
+
+
+def test_scalar_day_with_vector_columns():
+    shock = absolute_shock("DAY", 5.0)
+    block = ScenarioBlock(*scenarios().block())
+    engine = PricingEngine()
+    plan = compile_portfolio(portfolio())
+    expected = object_model_prices(block.rows(), engine, shock)
+    np.testing.assert_allclose(plan.price(shock(block), engine), expected)
+    positions = plan.position_prices(shock(block), engine)
+    np.testing.assert_allclose(positions.sum(axis=-1), expected)
+
+
+def central_difference(price, scenario, key, bump):
+    default = PricingEngine.default_equity_volatility  # missing volatilities
+    value = scenario.get(key, default)
+    up = price({**scenario, key: value + bump})
+    down = price({**scenario, key: value - bump})
+    return (up - down) / (2 * bump), (up - 2 * price(scenario) + down) / bump ** 2
+
+
+def test_vanilla_call_option_greeks_match_finite_differences():
+    engine = PricingEngine()
+    arguments = dict(
+        strike=np.array([70.0, 100.0]),
+        time_to_maturity=np.array([9.0, 19.0]),
+        spot_price=np.array([67.63, 106.1]),
+        volatility=np.array([0.8, 1.0]),
+        interest_rate=np.array([-0.0049, 0.01]),
+    )
+    greeks = engine.vanilla_call_option_greeks(**arguments)
+
+    def price(arguments):
+        return engine.vanilla_call_option_price(**arguments)
+
+    delta, gamma = central_difference(price, arguments, "spot_price", 1e-3)
+    np.testing.assert_allclose(greeks["delta"], delta, rtol=1e-6)
+    np.testing.assert_allclose(greeks["gamma"], gamma, rtol=1e-3)
+    vega, _ = central_difference(price, arguments, "volatility", 1e-5)
+    np.testing.assert_allclose(greeks["vega"], vega, rtol=1e-6)
+    rho, _ = central_difference(price, arguments, "interest_rate", 1e-5)
+    np.testing.assert_allclose(greeks["rho"], rho, rtol=1e-6)
+    theta, _ = central_difference(price, arguments, "time_to_maturity", 1e-5)
+    np.testing.assert_allclose(greeks["theta"], -theta, rtol=1e-6)
+    option = NORDEA.call_option(strike=70.0, maturity=10.0)
+    assert option.volatility(DEFAULT_MEAN_SCENARIO, engine) == pytest.approx(
+        engine.vanilla_call_option_greeks(
+            **option.pricing_arguments(DEFAULT_MEAN_SCENARIO, engine)
+        )["vega"]
+    )
+
+
+def test_portfolio_greeks_match_finite_differences():
+    engine = PricingEngine()
+    scenario = DEFAULT_MEAN_SCENARIO
+    greeks = portfolio().greeks(scenario, engine)
+
+    def price(scenario):
+        return portfolio().price(scenario, engine)
+
+    for ticker in [NORDEA_TICK, DANSKE_TICK]:
+        delta, gamma = central_difference(price, scenario, ticker, 1e-2)
+        assert greeks["delta"][ticker] == pytest.approx(delta, rel=1e-6)
+        assert greeks["gamma"][ticker] == pytest.approx(gamma, rel=1e-3)
+    for greek, keys, bump in [
+        ("vega", greeks["vega"], 1e-5),
+        ("rho", greeks["rho"], 1e-6),
+        ("theta", ["DAY"], 1e-4),
+    ]:
+        for key in keys:
+            expected = central_difference(price, scenario, key, bump)[0]
+            value = greeks[greek] if greek == "theta" else greeks[greek][key]
+            assert value == pytest.approx(expected, rel=1e-5)
+
+
+def test_shocks_can_be_pickled():
+    block = ScenarioBlock(*scenarios().block())
+    for shock in [
+        no_shock,
+        danske_100,
+        absolute_shock("DAY", 5.0),
+        relative_shock(NORDEA_TICK, 0.99) + danske_100,
+        0.5 * danske_100,
+    ]:
+        copy = pickle.loads(pickle.dumps(shock))
+        for key, column in {**shock(block)}.items():
+            np.testing.assert_array_equal(copy(block)[key], column)
+    assert pickle.loads(pickle.dumps(no_shock)) is no_shock
+
+
+def test_parallel_batch_simulation_with_spawn():
+    shock = relative_shock(NORDEA_TICK, 0.99)
+    generator = scenarios(count=3000)
+    engine = PricingEngineWithProxyAndResidual()
+    expected = VectorizedSimulation(portfolio(), generator, engine, shock).get_prices()
+    simulation = (
+        ParallelBatchSimulation(portfolio(), generator, engine, shock, workers=2)
+        .with_batch_size(1000)
+        .with_start_method("spawn")
+    )
+    np.testing.assert_allclose(simulation.get_prices(), expected)
+
+
+def test_experiment_grid_matches_a_simulation_per_cell():
+    from experiment_grid import ExperimentGrid
+
+    generator = scenarios(count=500)
+    shocks = [
+        ("-", no_shock),
+        ("Danske Bank = 100", danske_100),
+        ("Banks -100bps", relative_shock(NORDEA_TICK, 0.99)),
+    ]
+    models = [
+        ("Baseline", PricingEngine()),
+        ("Modified pricing", PricingEngineWithProxyAndResidual()),
+    ]
+    grid = ExperimentGrid(
+        shocks=shocks,
+        pricing_engines=[("Empty", None), *models],
+        portfolios=[("Default", portfolio())],
+        scenario_generator=generator,
+        workers=2,
+    )
+    # the loop of experiment.py before the grid
+    expected = []
+    for shock_name, shock in shocks:
+        cells = [("Empty", Simulation.empty())] + [
+            (name, Simulation(portfolio(), generator, engine))
+            for name, engine in models
+        ]
+        for model_name, model in cells:
+            model = model.clone().with_shock(shock)
+            expected.append(
+                dict(
+                    model=model_name,
+                    shock=shock_name,
+                    mean_price=model.mean_price,
+                    volatility=model.price_volatility,
+                )
+            )
+    pd.testing.assert_frame_equal(grid.run(), pd.DataFrame(expected), rtol=1e-9)
+
+
+@pytest.mark.parametrize(
+    "shock, affected",
+    [
+        (danske_100, [1, 3]),
+        (absolute_shock("EONIA", 0.01), [2]),
+        (absolute_shock("DAY", 5.0), [2, 3]),
+        (absolute_shock("UNUSED", 1.0), []),
+    ],
+)
+def test_reprice_matches_full_position_prices(shock, affected):
+    engine = PricingEngine()
+    block = ScenarioBlock(*scenarios().block()).columns()
+    plan = compile_portfolio(portfolio())
+    index = RiskFactorIndex(plan, engine)
+    shocked = shock(dict(block))
+    keys = changed_keys(block, shocked)
+    assert list(index.affected(keys)) == affected
+    base = plan.position_prices(block, engine)
+    np.testing.assert_allclose(
+        index.reprice(base, shocked, engine, keys),
+        plan.position_prices(shocked, engine),
+    )
+
+
+def test_approximation_error_against_full_revaluation():
+    generator = scenarios(count=2000)
+    shock = relative_shock(NORDEA_TICK, 0.99)
+    exact = VectorizedSimulation(portfolio(), generator, PricingEngine(), shock)
+    exact = exact.get_prices()[:500]
+    rms_errors = []
+    for order in [1, 2]:
+        simulation = Simulation(portfolio(), generator, PricingEngine(), shock)
+        simulation.with_approximation(order, sample_size=500)
+        block = shock(generator.scenario_block(0, 500))
+        error = simulation.portfolio.price(block, PricingEngine()) - exact
+        report = simulation.approximation_error()
+        assert report["sample_size"] == 500
+        assert report["mean_error"] == pytest.approx(np.mean(error))
+        assert report["max_abs_error"] == pytest.approx(np.max(np.abs(error)))
+        assert report["rms_error"] == pytest.approx(np.sqrt(np.mean(error ** 2)))
+        assert report["relative_rms_error"] < 1e-4
+        rms_errors.append(report["rms_error"])
+    assert rms_errors[1] < rms_errors[0] / 10  # gamma helps
+
+
+def test_numba_pricing_engine_matches_pricing_engine():
+    numba = pytest.importorskip("numba")
+    priority = list(numba.config.THREADING_LAYER_PRIORITY)
+    generator = scenarios(count=3000)
+    engine = NumbaPricingEngine()
+    expected = VectorizedSimulation(portfolio(), generator, PricingEngine())
+    simulation = VectorizedSimulation(portfolio(), generator, engine)
+    np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+    block = ScenarioBlock(*generator.block())
+    np.testing.assert_allclose(
+        compile_portfolio(portfolio()).position_prices(block, engine),
+        compile_portfolio(portfolio()).position_prices(block, PricingEngine()),
+    )
+    assert numba.config.THREADING_LAYER_PRIORITY == priority
+    # the workers also start when the parallel kernels have run here
+    simulation = ParallelBatchSimulation(
+        portfolio(), generator, engine, workers=2
+    ).with_batch_size(1000)
+    np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+
+
+def test_caching_pricing_engine_serves_vectorized_repeats_from_the_lru():
+    arguments = dict(
+        strike=np.array([100.0, 100.0, 110.0]),
+        time_to_maturity=np.array([10.0, 10.0, 20.0]),
+        spot_price=np.array([105.0, 105.0, 95.0]),
+        volatility=0.3,
+        interest_rate=0.01,
+    )
+    expected = PricingEngine().vanilla_call_option_price(**arguments)
+    engine = CachingPricingEngine()
+    np.testing.assert_allclose(engine.vanilla_call_option_price(**arguments), expected)
+    assert (engine.hits, engine.misses, engine.duplicates) == (0, 2, 1)
+    assert len(engine.prices) == 2
+    np.testing.assert_allclose(engine.vanilla_call_option_price(**arguments), expected)
+    assert (engine.hits, engine.misses, engine.duplicates) == (2, 2, 2)
+    scalar = {key: np.ravel(value)[0] for key, value in arguments.items()}
+    assert engine.vanilla_call_option_price(**scalar) == pytest.approx(expected[0])
+    assert (engine.hits, engine.misses) == (3, 2)
+    small = CachingPricingEngine(maxsize=1)
+    np.testing.assert_allclose(small.vanilla_call_option_price(**arguments), expected)
+    assert len(small.prices) == 1
+    # the plan prices repeated scenarios from the cache
+    block = ScenarioBlock(*scenarios().block())
+    plan = compile_portfolio(portfolio())
+    prices = plan.price(block, engine)
+    misses = engine.misses
+    np.testing.assert_allclose(plan.price(block, engine), prices)
+    np.testing.assert_allclose(prices, plan.price(block, PricingEngine()))
+    assert engine.misses == misses
+
+
+def test_parallel_batch_simulation_uses_the_configured_scenarios(tmp_path, monkeypatch):
+    filename = str(tmp_path / "scenarios.csv")
+    pd.DataFrame([DEFAULT_MEAN_SCENARIO] * 3).to_csv(filename, index=False)
+    monkeypatch.setitem(CONFIG, "scenarios", filename)
+    simulation = ParallelBatchSimulation(portfolio())
+    assert isinstance(simulation.scenario_generator, ScenarioFile)
+    with pytest.raises(Exception, match="needs a scenario generator with shards"):
+        simulation.get_prices()
+
+
+def test_shock_impact_simulation_streams_blocks():
+    shock = relative_shock(NORDEA_TICK, 0.99)
+    generator = scenarios(count=2500)
+    rows = list(generator())
+    expected = VectorizedSimulation(portfolio(), generator, PricingEngine(), shock)
+    for scenario_generator in [generator, lambda: iter(rows)]:
+        simulation = ShockImpactSimulation(
+            portfolio(), scenario_generator, PricingEngine(), shock
+        )
+        simulation.batch_size = 1000
+        np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+
+
+def test_monte_carlo_ranges_share_one_sampler(monkeypatch):
+    generator = scenarios(count=2500)
+    expected = monte_carlo_scenario_block(
+        DEFAULT_MEAN_SCENARIO, DEFAULT_COVARIANCE, DEFAULT_RANDOM_KEYS, 2500
+    )[0]
+    samplers, init = [], CorrelatedNormalSampler.__init__
+
+    def counting_init(self, *args):
+        samplers.append(self)
+        init(self, *args)
+
+    monkeypatch.setattr(CorrelatedNormalSampler, "__init__", counting_init)
+    blocks = [b.block for b in generator.blocks(1000)]
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
+    assert samplers == [generator.sampler]
+    assert pickle.loads(pickle.dumps(generator)).sampler is None
+
+
+def test_monte_carlo_blocks_are_streamed_without_the_cache():
+    SCENARIO_CACHE.clear()
+    generator = scenarios(count=2500)
+    blocks = list(generator.blocks(1000))
+    assert [len(b) for b in blocks] == [1000, 1000, 500]
+    assert SCENARIO_CACHE.bytes == 0
+    block, index = generator.block()
+    np.testing.assert_array_equal(np.concatenate([b.block for b in blocks]), block)
+
+
+def test_adaptive_batches_of_columnar_blocks():
+    expected = VectorizedSimulation(portfolio(), scenarios(count=2500), PricingEngine())
+    simulation = BatchSimulation(portfolio(), scenarios(count=2500), PricingEngine())
+    simulation.with_adaptive_batches(target_time=1e-6)  # halves the sizes
+    np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+    assert simulation.batcher.sizes[:3] == [1000, 500, 250]
+    assert sum(simulation.batcher.sizes) == 2500
+    # usable without blocks(), nothing priced - no change
+    batcher = AdaptiveBatcher(initial_size=300)
+    assert [batcher.next_block_size() for i in range(2)] == [300, 300]
+
+
+class CountingPricingEngine(PricingEngine):  # counts option evaluations
+    def __init__(self):
+        self.evaluations = 0
+
+    def vanilla_call_option_price(self, **arguments):
+        prices = super().vanilla_call_option_price(**arguments)
+        self.evaluations += np.size(prices)
+        return prices
+
+
+@pytest.mark.parametrize(
+    "ticker, evaluations", [(NORDEA_TICK, 2000), ("EONIA", 2000), (DANSKE_TICK, 1000)]
+)
+def test_shock_impact_simulation_prices_affected_positions_once_more(
+    ticker, evaluations
+):
+    book = Portfolio().with_asset(NORDEA.call_option(strike=70.0, maturity=10.0))
+    book = book.equity_position(10.0, DANSKE_TICK)
+    shock = absolute_shock(ticker, 1.0)
+    generator = scenarios(count=1000)
+    engine = CountingPricingEngine()
+    simulation = ShockImpactSimulation(book, generator, engine, shock)
+    expected = VectorizedSimulation(book, generator, PricingEngine(), shock)
+    np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+    assert engine.evaluations == evaluations
+
+
+@pytest.mark.parametrize("method", ["antithetic", "sobol"])
+def test_standard_error_of_dependent_samples(method):
+    generator = scenarios(count=4096, method=method)
+    simulation = VectorizedSimulation(portfolio(), generator, PricingEngine())
+    statistics = simulation.get_statistics()
+    prices = np.asarray(simulation.get_prices())
+    if method == "antithetic":
+        samples = prices.reshape(-1, 2).mean(axis=1)
+    else:
+        samples = prices.reshape(-1, SOBOL_REPLICATES).mean(axis=0)
+    expected = np.std(samples, ddof=method == "sobol") / np.sqrt(len(samples))
+    assert statistics.standard_error == pytest.approx(expected)
+    assert statistics.standard_error < 0.1 * statistics.std / np.sqrt(len(prices))
+    # the same from batches and shards accumulated in parallel
+    parallel = ParallelBatchSimulation(portfolio(), generator, PricingEngine())
+    parallel.with_batch_size(1000).with_workers(2).with_streaming()
+    assert parallel.get_statistics().standard_error == pytest.approx(expected)
+
+
+def test_target_standard_error_of_the_estimator():
+    engine = PricingEngine()
+    counts = {}
+    for method in ["random", "antithetic"]:
+        simulation = BatchSimulation(
+            portfolio(), scenarios(count=100_000, method=method), engine
+        )
+        simulation.batch_size = 1024
+        simulation.with_target_standard_error(1.0).with_streaming()
+        statistics = simulation.get_statistics()
+        assert statistics.standard_error <= 1.0
+        counts[method] = statistics.count
+    assert counts["antithetic"] == 1024 < counts["random"] < 100_000
+    # relative to a zero mean: compared absolutely
+    empty = BatchSimulation(NullAsset(), scenarios(count=10_000), NullPricingEngine())
+    empty.batch_size = 1024
+    empty.with_target_standard_error(0.01, relative=True).with_streaming()
+    assert empty.get_statistics().count == 1024
+
+
+def test_scenario_store_of_another_stream_version_is_regenerated(tmp_path):
+    from scenario_store import ScenarioStore, StoredMonteCarloScenarios
+
+    def generator(**kwargs):
+        return StoredMonteCarloScenarios(
+            tmp_path / "scenarios",
+            DEFAULT_MEAN_SCENARIO,
+            DEFAULT_COVARIANCE,
+            DEFAULT_RANDOM_KEYS,
+            **{"count": 100, **kwargs},
+        )
+
+    expected, index = scenarios().block()
+    store = generator().prepare()
+    assert set(store.header()) == {"keys", "fingerprint", "version"}
+    assert store.header()["version"] == SCENARIO_STREAM_VERSION
+    # a store written before the version: the same parameters, old scenarios
+    store.write(np.zeros_like(expected), index, generator().fingerprint())
+    header = store.header()
+    del header["version"]
+    with store.header_path.open("w") as f:
+        yaml.safe_dump(header, f)
+    np.testing.assert_array_equal(generator().block()[0], expected)
+    # other parameters
+    stored = generator(seed=5)
+    np.testing.assert_array_equal(stored.block()[0], scenarios(seed=5).block()[0])
+    blocks = list(stored.blocks(30))
+    assert [len(b) for b in blocks] == [30, 30, 30, 10]
+    assert blocks[0].block.base is not None  # views of the opened store
+
+
+def test_proxy_residuals_of_file_scenarios(tmp_path):
+    generator = scenarios(count=3000)
+    block = ScenarioBlock(*generator.block())
+    columns = [key for key in block.keys() if key != SCENARIO_INDEX_KEY]
+    filename = str(tmp_path / "scenarios.csv")
+    pd.DataFrame({key: block[key] for key in columns}).to_csv(filename, index=False)
+    engine = PricingEngineWithProxyAndResidual()
+    expected = VectorizedSimulation(portfolio(), generator, engine).get_prices()
+    # rows of a file are numbered like the Monte Carlo scenarios
+    file_scenarios = ScenarioFile(filename, block_size=1000)
+    prices = BatchSimulation(portfolio(), file_scenarios, engine).get_prices()
+    np.testing.assert_allclose(prices, expected)
+    rows = list(scenarios_from_file(filename, block_size=1000))
+    np.testing.assert_allclose(object_model_prices(rows, engine), expected)
+    assert [row[SCENARIO_INDEX_KEY] for row in rows] == list(range(3000))
+    # NaN - the proxy alone
+    plan = compile_portfolio(portfolio())
+    proxy = {**block.columns(), SCENARIO_INDEX_KEY: np.nan}
+    residuals = expected - plan.price(proxy, engine)
+    assert np.std(residuals) > 1.0
+    # without the index - drawn from the engine's seeded stream
+    unindexed = {key: block[key] for key in columns}
+    prices = plan.price(unindexed, PricingEngineWithProxyAndResidual())
+    np.testing.assert_array_equal(
+        prices, plan.price(unindexed, PricingEngineWithProxyAndResidual())
+    )
+    assert np.std(prices - plan.price(proxy, engine)) > 1.0
+    engine = PricingEngineWithProxyAndResidual()
+    danske = engine.equity_price(DEFAULT_MEAN_SCENARIO, DANSKE_TICK)
+    assert engine.equity_price(DEFAULT_MEAN_SCENARIO, DANSKE_TICK) == danske
+    assert portfolio().price(
+        DEFAULT_MEAN_SCENARIO, PricingEngineWithProxyAndResidual()
+    ) == pytest.approx(portfolio().price(DEFAULT_MEAN_SCENARIO, engine))
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".feather"])
+def test_arrow_scenario_files(tmp_path, suffix):
+    pyarrow = pytest.importorskip("pyarrow")  # optional
+
+    generator = scenarios(count=2500)
+    block = ScenarioBlock(*generator.block())
+    rows = [{**row, "UNUSED": 1.0} for row in block.rows()]
+    filename = str(tmp_path / f"scenarios{suffix}")
+    write_scenario_file(filename, lambda: iter(rows), block_size=1000)
+    if suffix == ".parquet":
+        assert pyarrow.parquet.ParquetFile(filename).num_row_groups == 3
+    # round trip
+    read = ScenarioBlock(*ScenarioFile(filename).block())
+    assert list(read.keys()) == [*block.keys(), "UNUSED"]
+    for key in block.keys():
+        np.testing.assert_array_equal(read[key], block[key])
+    # column projection
+    simulation = BatchSimulation(portfolio(), ScenarioFile(filename), PricingEngine())
+    simulation.with_projected_scenarios()
+    columns = simulation.scenario_generator.columns
+    assert "UNUSED" not in columns and NORDEA_TICK in columns
+    for scenarios_block in simulation.scenario_generator.blocks():
+        assert set(scenarios_block.keys()) <= {*columns, SCENARIO_INDEX_KEY}
+    expected = VectorizedSimulation(portfolio(), generator, PricingEngine())
+    np.testing.assert_allclose(simulation.get_prices(), expected.get_prices())
+    # row filter
+    selected = ScenarioFile(
+        filename, filter=pyarrow.dataset.field(SCENARIO_INDEX_KEY) >= 2000
+    )
+    selected = ScenarioBlock(*selected.block())
+    np.testing.assert_array_equal(selected[SCENARIO_INDEX_KEY], np.arange(2000, 2500))
+    np.testing.assert_array_equal(selected[NORDEA_TICK], block[NORDEA_TICK][2000:])
+
+
+def test_scenario_file_rows_keep_non_numeric_columns(tmp_path):
+    filename = str(tmp_path / "scenarios.csv")
+    rows = [{**DEFAULT_MEAN_SCENARIO, "DATE": f"2024-01-0{i + 1}"} for i in range(3)]
+    pd.DataFrame(rows).to_csv(filename, index=False)
+    read = list(scenarios_from_file(filename, block_size=2))
+    assert read == [{**row, SCENARIO_INDEX_KEY: i} for i, row in enumerate(rows)]
+    # the columnar blocks are numeric
+    block = ScenarioBlock(*ScenarioFile(filename).block())
+    assert "DATE" not in block and SCENARIO_INDEX_KEY in block
+    # the rows price like the blocks
+    engine = PricingEngineWithProxyAndResidual()
+    simulation = BatchSimulation(portfolio(), lambda: scenarios_from_file(filename))
+    simulation.with_pricing_engine(engine)
+    np.testing.assert_allclose(
+        simulation.get_prices(),
+        BatchSimulation(portfolio(), ScenarioFile(filename), engine).get_prices(),
+    )
+
+
+def test_float32_scenarios_keep_the_scenario_index_exact():
+    start = 20_000_000  # above 2 ** 24, not exact in float32
+    generator = scenarios(count=start + 8, dtype=np.float32)
+    block = generator.scenario_block(start, start + 8)
+    assert block.block.dtype == np.float32
+    np.testing.assert_array_equal(
+        block[SCENARIO_INDEX_KEY], np.arange(start, start + 8)
+    )
+    assert SCENARIO_INDEX_KEY in block and NORDEA_TICK in block
+    assert SCENARIO_INDEX_KEY not in ScenarioBlock(block.block, block.index)
+    assert "missing" not in block
+    float64 = ScenarioBlock(*scenarios().shard(None, start, start + 8))
+    for scenarios32 in [
+        block,
+        float64.astype(np.float32),
+        block[2:].astype(np.float32),
+    ]:
+        np.testing.assert_array_equal(
+            scenarios32[SCENARIO_INDEX_KEY],
+            float64[SCENARIO_INDEX_KEY][-len(scenarios32) :],
+        )
+    engine = PricingEngineWithProxyAndResidual()
+    np.testing.assert_array_equal(
+        engine.residuals(block), engine.residuals(float64.columns())
+    )
+    rows = list(block.rows())
+    assert [row[SCENARIO_INDEX_KEY] for row in rows] == list(range(start, start + 8))